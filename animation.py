@@ -0,0 +1,197 @@
+import os
+import resource
+import signal
+import subprocess
+import tempfile
+import time
+from io import BytesIO
+from threading import Timer
+
+from PIL import Image, ImageSequence
+
+from conversion import ConversionFailed, format_image, sticker_size
+
+# limits telegram puts on video stickers
+VIDEO_STICKER_MAX_BYTES = 256 * 1024
+VIDEO_STICKER_MAX_SECONDS = 3
+VIDEO_STICKER_MAX_FPS = 30
+
+# frames of gifs that don't say how long to show them are shown as long as browsers show them
+DEFAULT_FRAME_MS = 100
+
+# bitrates tried in turn until the sticker fits telegram's size limit
+BITRATES_KBPS = (600, 300, 150)
+
+# options every ffmpeg run starts with, it decodes and filters with a single thread since each thread reserves stacks
+# and memory arenas that count towards its memory limit even when they are never used
+FFMPEG_OPTIONS = ['-v', 'error', '-y', '-filter_threads', '1', '-threads', '1']
+
+# seconds before the conversion engine gives up on a job that ffmpeg is stopped so the user is told why
+DEADLINE_MARGIN = 1
+
+
+# reason is the lang.json message telling the user why their animation couldn't be used
+class AnimationError(ConversionFailed):
+    def __init__(self, reason, detail=None):
+        super().__init__(reason, detail)
+        self.reason = reason
+        self.detail = detail
+
+
+# makes gifs, animated webps and short videos into webm video stickers with ffmpeg, still images and icons are made
+# into png stickers the usual way, deadline is the time.time() every run of ffmpeg has to finish by
+def format_animation(data, make_icon, encoder, ffmpeg, max_pixels, memory_limit, deadline):
+    try:
+        image = Image.open(BytesIO(data))
+    except OSError:
+        # pillow can't read videos so ffmpeg decodes them
+        image = None
+
+    # icons are made from the first frame
+    still = make_icon or image is not None and not getattr(image, 'is_animated', False)
+    if still:
+        if image is not None:
+            image.close()
+        else:
+            data = first_frame(ffmpeg, data, memory_limit, deadline)
+        document, stats = format_image(data, make_icon, encoder)
+        return document, dict(stats, animated=False)
+
+    # frames are decoded one at a time so only the size of one frame has to be limited
+    if image is not None and image.size[0] * image.size[1] > max_pixels:
+        image.close()
+        raise AnimationError('animation_too_large')
+
+    with tempfile.TemporaryDirectory() as directory:
+        output_path = os.path.join(directory, 'sticker.webm')
+        if image is None:
+            source_path = os.path.join(directory, 'source')
+            with open(source_path, 'wb') as source:
+                source.write(data)
+
+        try:
+            # the time left is shared by every bitrate tried
+            for bitrate in BITRATES_KBPS:
+                if image is None:
+                    encode_video(ffmpeg, source_path, output_path, bitrate, memory_limit, deadline)
+                else:
+                    image.seek(0)
+                    encode_frames(ffmpeg, image, output_path, bitrate, memory_limit, deadline)
+                if os.path.getsize(output_path) <= VIDEO_STICKER_MAX_BYTES:
+                    break
+            else:
+                raise AnimationError('animation_too_large')
+        # frames pillow can't decode like those of a truncated gif
+        except OSError as e:
+            raise AnimationError('animation_failed', "Couldn't decode animation: {}".format(e))
+        finally:
+            if image is not None:
+                image.close()
+
+        with open(output_path, 'rb') as output:
+            document = output.read()
+    return document, {'animated': True, 'bitrate': bitrate, 'bytes': len(document)}
+
+
+def encode_frames(ffmpeg, image, output_path, bitrate, memory_limit, deadline):
+    size = sticker_size(*image.size)
+    command = [ffmpeg] + FFMPEG_OPTIONS + ['-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', '{}x{}'.format(*size),
+               '-r', str(VIDEO_STICKER_MAX_FPS), '-i', '-'] + webm_arguments(bitrate) + [output_path]
+    # ffmpeg takes frames as fast as it encodes them so frames are never decoded far ahead of it
+    run_ffmpeg(command, memory_limit, deadline, animation_frames(image, size))
+
+
+def encode_video(ffmpeg, source_path, output_path, bitrate, memory_limit, deadline):
+    # longest side is made 512 like stickers from images while keeping the sides even for the encoder
+    scale = "scale='if(gte(iw,ih),512,-2)':'if(gte(iw,ih),-2,512)',fps={}".format(VIDEO_STICKER_MAX_FPS)
+    command = [ffmpeg] + FFMPEG_OPTIONS + ['-t', str(VIDEO_STICKER_MAX_SECONDS), '-i', source_path,
+               '-vf', scale] + webm_arguments(bitrate) + [output_path]
+    run_ffmpeg(command, memory_limit, deadline)
+
+
+def first_frame(ffmpeg, data, memory_limit, deadline):
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, 'source')
+        output_path = os.path.join(directory, 'frame.png')
+        with open(source_path, 'wb') as source:
+            source.write(data)
+        command = [ffmpeg] + FFMPEG_OPTIONS + ['-i', source_path, '-frames:v', '1', '-f', 'image2', '-c:v', 'png',
+                   output_path]
+        run_ffmpeg(command, memory_limit, deadline)
+        with open(output_path, 'rb') as output:
+            return output.read()
+
+
+def webm_arguments(bitrate):
+    # vp9 with an alpha channel and no audio is the only format telegram takes for video stickers, encoded with a
+    # single thread like it is decoded
+    return ['-t', str(VIDEO_STICKER_MAX_SECONDS), '-an', '-c:v', 'libvpx-vp9', '-pix_fmt', 'yuva420p',
+            '-b:v', '{}k'.format(bitrate), '-threads', '1', '-f', 'webm']
+
+
+def animation_frames(image, size):
+    # frames are shown for different lengths of time so each is repeated for as many frames of the output it covers
+    elapsed = 0
+    written = 0
+    end = VIDEO_STICKER_MAX_SECONDS * 1000
+    for frame in ImageSequence.Iterator(image):
+        if elapsed >= end:
+            break
+        elapsed = min(elapsed + (frame.info.get('duration') or DEFAULT_FRAME_MS), end)
+        due = round(elapsed * VIDEO_STICKER_MAX_FPS / 1000) - written
+        if due <= 0:
+            continue
+
+        with frame.convert('RGBA') as rgba, rgba.resize(size, Image.ANTIALIAS) as resized:
+            data = resized.tobytes()
+        for _ in range(due):
+            yield data
+        written += due
+
+
+def limit_memory(memory_limit):
+    # ffmpeg is stopped instead of being allowed to use up the memory of the machine
+    def set_limit():
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    return set_limit
+
+
+def run_ffmpeg(command, memory_limit, deadline, frames=None):
+    # errors go to a file so ffmpeg can't block on a full pipe while frames are still being written to it
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL if frames is None else subprocess.PIPE,
+                                   stdout=subprocess.DEVNULL, stderr=errors, preexec_fn=limit_memory(memory_limit),
+                                   start_new_session=True)
+        # killed from a timer as writing frames can block as long as ffmpeg does, along with anything it started that
+        # could keep the pipe open
+        timer = Timer(max(deadline - time.time(), 0), kill_group, (process,))
+        timer.start()
+        try:
+            if frames is not None:
+                try:
+                    for frame in frames:
+                        process.stdin.write(frame)
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            process.wait()
+        finally:
+            timer.cancel()
+            if process.poll() is None:
+                kill_group(process)
+                process.wait()
+
+        if process.returncode == -signal.SIGKILL:
+            raise AnimationError('animation_failed', "ffmpeg didn't finish before the conversion timed out")
+        if process.returncode != 0:
+            errors.seek(0)
+            raise AnimationError('animation_failed', errors.read().decode('utf-8', 'replace').strip())
+
+
+def kill_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+from threading import Thread
+
+import aiohttp
+from telegram.error import TelegramError, BadRequest, ChatMigrated, Conflict, InvalidToken, NetworkError, \
+    RetryAfter, TimedOut, Unauthorized
+
+logger = logging.getLogger()
+
+API_URL = 'https://api.telegram.org/bot'
+FILE_URL = 'https://api.telegram.org/file/bot'
+
+
+# runs an asyncio event loop in its own thread so handlers can hand it coroutines from the dispatcher threads
+class EventLoop:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._run, name="event_loop", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        future.add_done_callback(log_exception)
+        return future
+
+    def run(self, coroutine, timeout=None):
+        # wait for a coroutine from outside the loop
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def wait(self, timeout):
+        # wait for coroutines already running on the loop to finish
+        async def wait_for_tasks():
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            if tasks:
+                await asyncio.wait(tasks, timeout=timeout)
+
+        self.run(wait_for_tasks())
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+
+# bot api client for the event loop that keeps connections to telegram open between calls
+class AsyncBot:
+    def __init__(self, token, max_connections, timeout, base_url=API_URL, base_file_url=FILE_URL):
+        self.token = token
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.base_url = base_url + token
+        self.base_file_url = base_file_url + token
+        self._session = None
+
+    async def send_chat_action(self, chat_id, action):
+        return await self.call('sendChatAction', chat_id=chat_id, action=action)
+
+    async def send_message(self, chat_id, text, parse_mode=None, reply_to_message_id=None, reply_markup=None,
+                           disable_web_page_preview=None):
+        return await self.call('sendMessage', chat_id=chat_id, text=text, parse_mode=parse_mode,
+                               reply_to_message_id=reply_to_message_id, reply_markup=reply_markup,
+                               disable_web_page_preview=disable_web_page_preview)
+
+    async def send_document(self, chat_id, document, filename=None, caption=None, reply_to_message_id=None,
+                            reply_markup=None, disable_content_type_detection=None):
+        # a str is the file_id of a document telegram already has, bytes are uploaded
+        return await self.call('sendDocument', chat_id=chat_id, document=document, filename=filename,
+                               caption=caption, reply_to_message_id=reply_to_message_id, reply_markup=reply_markup,
+                               disable_content_type_detection=disable_content_type_detection)
+
+    async def edit_message_reply_markup(self, chat_id, message_id, reply_markup):
+        return await self.call('editMessageReplyMarkup', chat_id=chat_id, message_id=message_id,
+                               reply_markup=reply_markup)
+
+    async def download_file(self, file_id):
+        file = await self.get_file(file_id)
+        return await self.download(file['file_path'])
+
+    async def get_file(self, file_id):
+        return await self.call('getFile', file_id=file_id)
+
+    async def download(self, file_path):
+        try:
+            async with self.session().get('{}/{}'.format(self.base_file_url, file_path)) as response:
+                if response.status != 200:
+                    raise NetworkError("Download failed ({})".format(response.status))
+                return await response.read()
+        except asyncio.TimeoutError:
+            raise TimedOut
+        except aiohttp.ClientError as e:
+            raise NetworkError(str(e))
+
+    async def call(self, method, filename=None, **params):
+        url = '{}/{}'.format(self.base_url, method)
+        params = {key: value.to_dict() if hasattr(value, 'to_dict') else value
+                  for key, value in params.items() if value is not None}
+
+        # files have to be sent as multipart form data with every other parameter as a string
+        if any(isinstance(value, bytes) for value in params.values()):
+            data = aiohttp.FormData()
+            for key, value in params.items():
+                if isinstance(value, bytes):
+                    data.add_field(key, value, filename=filename or key)
+                else:
+                    data.add_field(key, value if isinstance(value, str) else json.dumps(value))
+            request = {'data': data}
+        else:
+            request = {'json': params}
+
+        try:
+            async with self.session().post(url, **request) as response:
+                return parse_response(response.status, await response.read())
+        except asyncio.TimeoutError:
+            raise TimedOut
+        except aiohttp.ClientError as e:
+            raise NetworkError(str(e))
+
+    def session(self):
+        # sessions have to be created on the loop they are used from
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+def parse_response(status, body):
+    # same errors python-telegram-bot raises so handlers catch them the same way
+    try:
+        data = json.loads(body.decode('utf-8'))
+    except ValueError:
+        raise TelegramError("Invalid server response")
+
+    if data.get('ok'):
+        return data['result']
+
+    description = data.get('description', "Unknown error")
+    parameters = data.get('parameters') or {}
+    if 'retry_after' in parameters:
+        raise RetryAfter(parameters['retry_after'])
+    if 'migrate_to_chat_id' in parameters:
+        raise ChatMigrated(parameters['migrate_to_chat_id'])
+    if status in (401, 403):
+        raise Unauthorized(description)
+    if status == 400:
+        raise BadRequest(description)
+    if status == 404:
+        raise InvalidToken()
+    if status == 409:
+        raise Conflict(description)
+    raise NetworkError("{} ({})".format(description, status))
+
+
+def log_exception(future):
+    if not future.cancelled() and future.exception() is not None:
+        exception = future.exception()
+        logger.error("Error in event loop handler", exc_info=(type(exception), exception, exception.__traceback__))
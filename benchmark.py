@@ -0,0 +1,288 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import PIL
+from PIL import Image, ImageChops, ImageDraw, ImageStat, features
+
+from conversion import ENCODERS, ConversionEngine, format_image, resize_sticker, sticker_size
+
+# phone camera resolutions benchmarked by default
+SIZES = [(4032, 3024), (3264, 2448), (1920, 1080), (1024, 768)]
+
+# largest mean per channel difference allowed between the reference and the fast resize
+TOLERANCE = 2.0
+
+# baseline the pipeline benchmark compares against unless another is given, the committed one only has the sizes of
+# the files made since times and memory depend on the machine
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# results of each image and mode a baseline can keep
+MEASURES = ('p50', 'p99', 'rss', 'bytes')
+
+# differences smaller than these are noise between runs rather than regressions
+NOISE = {'p50': 2.0, 'p99': 2.0, 'rss': 1024, 'bytes': 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark making stickers and icons")
+    commands = parser.add_subparsers(dest='command')
+
+    resize_parser = commands.add_parser('resize', help="compare decoding and resizing jpegs against a full "
+                                                       "resolution resize")
+    resize_parser.add_argument('-r', '--runs', type=int, default=5, help="timed runs per image")
+
+    pipeline_parser = commands.add_parser('pipeline', help="time the sticker and icon conversions on a generated "
+                                                           "corpus and compare them against a baseline")
+    pipeline_parser.add_argument('-r', '--runs', type=int, default=20, help="timed runs per image and mode")
+    pipeline_parser.add_argument('-e', '--encoder', choices=ENCODERS, default='adaptive', help="png encoder")
+    pipeline_parser.add_argument('-w', '--workers', type=int, default=2,
+                                 help="conversion worker processes used to measure throughput")
+    pipeline_parser.add_argument('-b', '--baseline', help="baseline file, {} by default".format(
+        os.path.basename(BASELINE_PATH)))
+    pipeline_parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                                 help="fraction a result can be worse than the baseline before it is a regression")
+    pipeline_parser.add_argument('-s', '--save-baseline', action='store_true',
+                                 help="save the results as the new baseline instead of comparing them")
+    pipeline_parser.add_argument('-m', '--measures', nargs='+', choices=MEASURES + ('throughput',),
+                                 default=MEASURES + ('throughput',), help="results saved in the baseline")
+
+    args = parser.parse_args()
+    if args.command == 'pipeline':
+        pipeline_benchmark(args)
+    else:
+        # running the resize comparison was the only thing the benchmark did before it had commands
+        resize_benchmark(args.runs if args.command == 'resize' else 5)
+
+
+def resize_benchmark(runs):
+    print("{:>11} {:>12} {:>12} {:>14} {:>14} {:>9}".format("size", "ref ms/MP", "fast ms/MP", "ref RSS KB/MP",
+                                                            "fast RSS KB/MP", "diff"))
+    failed = False
+    for width, height in SIZES:
+        data = make_jpeg(width, height)
+        megapixels = width * height / 1000000
+
+        ref_time = time_runs(reference_resize, data, runs) / megapixels
+        fast_time = time_runs(fast_resize, data, runs) / megapixels
+        ref_rss = peak_rss(reference_resize, data) / megapixels
+        fast_rss = peak_rss(fast_resize, data) / megapixels
+        diff = mean_difference(reference_resize(data), fast_resize(data))
+        failed |= diff > TOLERANCE
+
+        print("{:>11} {:>12.2f} {:>12.2f} {:>14.0f} {:>14.0f} {:>9.3f}".format(
+            "{}x{}".format(width, height), ref_time, fast_time, ref_rss, fast_rss, diff))
+
+    if failed:
+        raise SystemExit("fast resize differs from reference by more than {}".format(TOLERANCE))
+
+
+def make_jpeg(width, height):
+    # gradient with noise so the jpeg encodes and decodes like a photo rather than a flat color
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    image = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def reference_resize(data):
+    # full resolution decode followed by a single lanczos pass
+    with Image.open(BytesIO(data)) as image:
+        return image.resize(sticker_size(*image.size), Image.ANTIALIAS)
+
+
+def fast_resize(data):
+    with Image.open(BytesIO(data)) as image:
+        return resize_sticker(image)
+
+
+def time_runs(func, data, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(data).close()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def peak_rss(func, *args):
+    # run in a fresh process so earlier runs don't hide this one's peak
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(rss_increase, func, *args).result()
+
+
+def rss_increase(func, *args):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = func(*args)
+    if isinstance(result, Image.Image):
+        result.close()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+
+def mean_difference(first, second):
+    return max(ImageStat.Stat(ImageChops.difference(first, second)).mean)
+
+
+def pipeline_benchmark(args):
+    corpus = make_corpus()
+    results = {}
+
+    print("{:>22} {:>8} {:>9} {:>9} {:>12} {:>10}".format("image", "mode", "p50 ms", "p99 ms", "peak RSS KB",
+                                                          "bytes"))
+    for name, data in corpus.items():
+        for make_icon in (False, True):
+            mode = 'icon' if make_icon else 'sticker'
+            times = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                document, _ = format_image(data, make_icon, args.encoder)
+                times.append((time.perf_counter() - start) * 1000)
+            result = {'p50': percentile(times, 50), 'p99': percentile(times, 99),
+                      'rss': peak_rss(format_image, data, make_icon, args.encoder), 'bytes': len(document)}
+            results['{}/{}'.format(name, mode)] = result
+
+            print("{:>22} {:>8} {:>9.2f} {:>9.2f} {:>12} {:>10}".format(name, mode, result['p50'], result['p99'],
+                                                                       result['rss'], result['bytes']))
+
+    throughput = asyncio.run(measure_throughput(corpus, args.encoder, args.workers, args.runs))
+    results['throughput'] = throughput
+    print("throughput with {} workers: {:.1f} images/s".format(args.workers, throughput))
+
+    baseline_path = args.baseline or BASELINE_PATH
+    if args.save_baseline:
+        saved = {key: result if key == 'throughput' else
+                 {measure: value for measure, value in result.items() if measure in args.measures}
+                 for key, result in results.items() if key != 'throughput' or 'throughput' in args.measures}
+        saved['libraries'] = image_libraries()
+        with open(baseline_path, 'w') as file:
+            json.dump(saved, file, indent=4, sort_keys=True)
+        print("saved baseline to {}".format(baseline_path))
+        return
+
+    try:
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        # a baseline that was asked for has to be there or a regression would go unnoticed
+        if args.baseline is not None:
+            raise SystemExit("no baseline at {}".format(baseline_path))
+        print("no baseline at {}, save one with --save-baseline".format(baseline_path))
+        return
+
+    # file sizes depend on the libraries pillow was built with as much as on the code so they are only compared when
+    # the baseline was saved with the same ones
+    measures = MEASURES
+    if baseline.get('libraries') != image_libraries():
+        measures = tuple(measure for measure in MEASURES if measure != 'bytes')
+        print("baseline was saved with {}, not comparing file sizes".format(
+            ', '.join('{} {}'.format(name, version) for name, version in baseline.get('libraries', {}).items()) or
+            "unknown image libraries"))
+
+    regressions = compare(results, baseline, args.threshold, measures)
+    for regression in regressions:
+        print("regression: " + regression)
+    if regressions:
+        raise SystemExit("{} results are more than {:.0%} worse than the baseline".format(len(regressions),
+                                                                                         args.threshold))
+    print("no regressions against {}".format(baseline_path))
+
+
+def make_corpus():
+    # the same images are generated on every run so results can be compared against a saved baseline
+    corpus = {}
+    for width, height in ((4032, 3024), (1920, 1080)):
+        corpus['photo_{}x{}.jpg'.format(width, height)] = save(make_photo(width, height, seed=width), 'JPEG',
+                                                              quality=90)
+
+    corpus['transparent_1200.png'] = save(make_transparent(1200, 1200), 'PNG')
+    corpus['sticker_512.webp'] = save(make_transparent(512, 512), 'WEBP', quality=80)
+    corpus['tiny_16.png'] = save(make_transparent(16, 16), 'PNG')
+    corpus['wide_4000x200.jpg'] = save(make_photo(4000, 200, seed=4000), 'JPEG', quality=90)
+    corpus['tall_150x3000.png'] = save(make_transparent(150, 3000), 'PNG')
+
+    with make_photo(800, 600, seed=800) as photo:
+        corpus['palette_800x600.png'] = save(photo.quantize(colors=16), 'PNG')
+    return corpus
+
+
+def make_photo(width, height, seed):
+    # gradient with seeded noise so it encodes like a photo and is the same every run
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.frombytes('L', (width, height), random.Random(seed).randbytes(width * height))
+    noise = Image.blend(gradient, noise, 0.3)
+    return Image.merge('RGB', (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+
+
+def make_transparent(width, height):
+    # flat colored shapes on a transparent background like most stickers
+    image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((width // 10, height // 10, width * 9 // 10, height * 9 // 10), fill=(240, 180, 40, 255),
+                 outline=(20, 20, 20, 255), width=max(1, min(width, height) // 40))
+    draw.rectangle((width // 3, height // 3, width * 2 // 3, height * 2 // 3), fill=(60, 120, 220, 200))
+    return image
+
+
+def save(image, image_format, **params):
+    buffer = BytesIO()
+    with image:
+        image.save(buffer, format=image_format, **params)
+    return buffer.getvalue()
+
+
+async def measure_throughput(corpus, encoder, workers, runs):
+    # conversions go through the same engine the bot uses with every image made into both a sticker and an icon
+    jobs = [(data, make_icon) for data in corpus.values() for make_icon in (False, True)] * max(1, runs // 4)
+    engine = ConversionEngine(workers, len(jobs), 600, len(jobs) + workers, encoder)
+    try:
+        # start every worker process before timing
+        await asyncio.gather(*(engine.convert(corpus['tiny_16.png'], False) for _ in range(workers)))
+        start = time.perf_counter()
+        await asyncio.gather(*(engine.convert(data, make_icon) for data, make_icon in jobs))
+        return len(jobs) / (time.perf_counter() - start)
+    finally:
+        engine.shutdown()
+
+
+def percentile(values, percent):
+    # nearest rank so small numbers of runs still give one of the measured values
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * percent / 100) - 1)]
+
+
+def image_libraries():
+    return {'pillow': PIL.__version__, 'zlib': features.version('zlib'), 'libjpeg': features.version('jpg'),
+            'libwebp': features.version('webp')}
+
+
+def compare(results, baseline, threshold, measures):
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        if key == 'throughput':
+            if result < baseline[key] * (1 - threshold):
+                regressions.append("throughput {:.1f} images/s was {:.1f}".format(result, baseline[key]))
+            continue
+        # baselines only have the measures they were saved with
+        for measure in measures:
+            if measure not in baseline[key]:
+                continue
+            if result[measure] > baseline[key][measure] * (1 + threshold) + NOISE[measure]:
+                regressions.append("{} {} {:.2f} was {:.2f}".format(key, measure, result[measure],
+                                                                   baseline[key][measure]))
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+
+from telegram.error import TelegramError, RetryAfter, Unauthorized, BadRequest
+
+from storage import write_atomic
+
+logger = logging.getLogger()
+
+# telegram allows bursts of about one message per second to the same chat
+PER_CHAT_INTERVAL = 1.0
+
+# attempts to send a message that keeps getting RetryAfter before the user is counted as failed
+MAX_ATTEMPTS = 5
+
+
+# limits how fast messages are sent and lets flood control errors pause every sender at once
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def back_off(self, seconds):
+        # stop sending for as long as telegram asked and come back at half the rate
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._updated = self._paused_until
+            self._tokens = 0
+            self.rate = max(1.0, self.rate / 2)
+
+    def recover(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+# sends a message to every user in batches and saves its progress after each batch so it can resume
+class Broadcast:
+    def __init__(self, bot, users, get_message, config, state_path, state):
+        self.bot = bot
+        self.users = users
+        self.get_message = get_message
+        self.config = config
+        self.state_path = state_path
+        self.state = state
+        self.bucket = TokenBucket(config['broadcast_rate'], config['broadcast_rate'])
+        self._counts_lock = Lock()
+
+    @staticmethod
+    def new_state(message, admin_id):
+        return {'message': message, 'admin_id': admin_id, 'cursor': 0, 'done': 0, 'sent': 0, 'skipped': 0,
+                'blocked': 0, 'failed': 0}
+
+    @staticmethod
+    def load_state(state_path):
+        try:
+            with open(state_path) as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return None
+
+    def start(self):
+        thread = Thread(target=self.run, name="broadcast", daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        # users are broadcast to in id order so the cursor is the last id of the last finished batch
+        user_ids = [user_id for user_id in self.users.ids() if user_id > self.state['cursor']]
+        total = self.state['done'] + len(user_ids)
+        batch_size = self.config['broadcast_batch_size']
+        started = time.monotonic()
+        start_done = self.state['done']
+        last_report = started
+        write_atomic(self.state_path, json.dumps(self.state))
+
+        with ThreadPoolExecutor(max_workers=self.config['broadcast_workers']) as executor:
+            for index in range(0, len(user_ids), batch_size):
+                batch = user_ids[index:index + batch_size]
+
+                # skip users who opted out or have blocked the bot, read for each batch from the store itself since
+                # users change their settings through other workers during a broadcast
+                targets = self.users.broadcast_targets(batch[0], batch[-1], self.config['override_opt_out'])
+                self.count('skipped', len([user_id for user_id in batch if user_id not in targets]))
+                list(executor.map(self.send, [user_id for user_id in batch if user_id in targets]))
+
+                self.state['cursor'] = batch[-1]
+                self.state['done'] += len(batch)
+                write_atomic(self.state_path, json.dumps(self.state))
+                self.bucket.recover()
+
+                # tell the admin how far along the broadcast is every so often
+                now = time.monotonic()
+                if now - last_report >= self.config['broadcast_report_interval']:
+                    last_report = now
+                    self.report("broadcast_progress", total, (self.state['done'] - start_done) / (now - started))
+
+        os.remove(self.state_path)
+        elapsed = max(time.monotonic() - started, 0.001)
+        self.report("broadcast_finished", total, (self.state['done'] - start_done) / elapsed)
+
+    def send(self, user_id):
+        try:
+            self.send_message(user_id, self.state['message'], parse_mode='HTML', disable_web_page_preview=True)
+            # send opt out message
+            if self.config['send_opt_out_message']:
+                time.sleep(PER_CHAT_INTERVAL)
+                self.send_message(user_id, self.get_message(user_id, "opt_out_info"))
+            self.count('sent')
+        # mark users who stopped the bot so later broadcasts skip them
+        except Unauthorized:
+            self.users.set(user_id, 'blocked', True)
+            self.count('blocked')
+        except BadRequest as e:
+            if e.message == 'Chat not found':
+                self.users.set(user_id, 'blocked', True)
+                self.count('blocked')
+            else:
+                logger.warning("Error '{}' when broadcasting message to {}".format(e.message, user_id))
+                self.count('failed')
+        except TelegramError as e:
+            logger.warning("Error '{}' when broadcasting message to {}".format(e.message, user_id))
+            self.count('failed')
+
+    def send_message(self, user_id, text, **kwargs):
+        for attempt in range(MAX_ATTEMPTS):
+            self.bucket.acquire()
+            try:
+                return self.bot.send_message(chat_id=user_id, text=text, **kwargs)
+            except RetryAfter as e:
+                self.bucket.back_off(e.retry_after)
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+
+    def count(self, key, amount=1):
+        with self._counts_lock:
+            self.state[key] += amount
+
+    def report(self, message, total, rate):
+        text = self.get_message(self.state['admin_id'], message).format(
+            self.state['done'], total, self.state['sent'], self.state['skipped'], self.state['blocked'],
+            self.state['failed'], rate)
+        try:
+            self.bot.send_message(chat_id=self.state['admin_id'], text=text, parse_mode='Markdown')
+        except TelegramError as e:
+            logger.warning("Error '{}' when reporting broadcast progress".format(e.message))
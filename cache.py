@@ -0,0 +1,67 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+# maps a conversion key to the file_id telegram gave back after the first upload of that conversion
+class ConversionCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(source_id, mode, version, encoder):
+        # each png encoder makes different files so switching encoders doesn't reuse files made by the old one
+        return "{}:{}:{}:{}".format(source_id, mode, version, encoder)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            # treat expired entries as missing and drop them
+            if entry is not None and time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, file_id):
+        with self._lock:
+            self._entries[key] = (file_id, time.time())
+            self._entries.move_to_end(key)
+
+            # evict least recently used entries until cache is within its size bound
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def dump(self):
+        # entries are dumped from least to most recently used so load restores the same order
+        with self._lock:
+            return [[key, file_id, stored_at] for key, (file_id, stored_at) in self._entries.items()]
+
+    def load(self, entries):
+        now = time.time()
+        with self._lock:
+            self._entries.clear()
+            for key, file_id, stored_at in entries:
+                if now - stored_at <= self.ttl:
+                    self._entries[key] = (file_id, stored_at)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
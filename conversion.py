@@ -0,0 +1,242 @@
+import asyncio
+import time
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from threading import Lock
+
+from PIL import Image, ImageChops
+
+ENCODERS = ('fast', 'optimal', 'adaptive')
+
+# telegram rejects sticker files larger than this
+STICKER_MAX_BYTES = 512 * 1024
+
+# images up to this many pixels are always fully optimized by the adaptive encoder
+ADAPTIVE_OPTIMIZE_PIXELS = 256 * 256
+
+
+class EngineBusy(Exception):
+    pass
+
+
+# a job raised instead of returning, the error it raised is the cause
+class ConversionFailed(Exception):
+    pass
+
+
+# runs image conversions in a pool of worker processes so they don't hold the GIL of the bot process
+class ConversionEngine:
+    def __init__(self, workers, max_queue, timeout, recycle_after, encoder):
+        if encoder not in ENCODERS:
+            raise ValueError("Unknown png encoder '{}'".format(encoder))
+
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.recycle_after = recycle_after
+        self.encoder = encoder
+        self._lock = Lock()
+        self._pending = 0
+        self._jobs = 0
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    async def convert(self, data, make_icon):
+        return await self.run(format_image, data, make_icon, self.encoder)
+
+    async def run(self, func, *args):
+        # refuse new jobs instead of queueing them without bound
+        with self._lock:
+            if self._pending >= self.max_queue:
+                raise EngineBusy
+            self._pending += 1
+
+            # replace the pool after a number of jobs so worker processes can't keep growing in memory
+            if self._jobs >= self.recycle_after:
+                self._recycle()
+            self._jobs += 1
+            executor = self._executor
+
+        try:
+            future = executor.submit(func, *args)
+        except BrokenProcessPool:
+            self._job_done(None)
+            self._retire(executor)
+            raise
+        future.add_done_callback(self._job_done)
+
+        # wait on the event loop without holding a thread for each conversion
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        # a running job can't be cancelled and a crashed worker breaks its pool so retire the pool either way
+        except asyncio.TimeoutError:
+            self._retire(executor)
+            raise futures.TimeoutError
+        except BrokenProcessPool:
+            self._retire(executor)
+            raise
+        # pillow can raise nearly anything for images it can't handle
+        except ConversionFailed:
+            raise
+        except Exception as e:
+            raise ConversionFailed(e) from e
+
+    def shutdown(self):
+        with self._lock:
+            self._executor.shutdown(wait=False)
+
+    def _job_done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def _retire(self, executor):
+        with self._lock:
+            if executor is not self._executor:
+                return
+            processes = list(executor._processes.values())
+            self._recycle()
+
+        # shutting down doesn't stop a worker stuck in a job so they are killed, other jobs still running in the pool
+        # fail as if their worker had crashed
+        for process in processes:
+            process.terminate()
+
+    def _recycle(self):
+        # old pool finishes the jobs it already has and then its workers exit
+        self._executor.shutdown(wait=False)
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._jobs = 0
+
+
+# resizes change size by at least this factor after any cheap integer reduction
+REDUCING_GAP = 3.0
+
+
+def format_image(data, make_icon, encoder):
+    start = time.perf_counter()
+    image = Image.open(BytesIO(data))
+    source_format = image.format
+
+    # if user is making icon
+    if make_icon:
+        # thumbnail already decodes jpegs in draft mode and reduces before resampling so decoding icons is timed
+        # as part of resizing them
+        decode_time = None
+        image.thumbnail((100, 100), Image.ANTIALIAS)
+        background = Image.new('RGBA', (100, 100), (255, 255, 255, 0))
+        background.paste(image, (int(((100 - image.size[0]) / 2)), int(((100 - image.size[1]) / 2))))
+        image.close()
+        image = background
+        resized_at = time.perf_counter()
+
+    # else format image to sticker
+    else:
+        new_size = draft_sticker(image)
+        image.load()
+        decoded_at = time.perf_counter()
+        decode_time = decoded_at - start
+        resized = image.resize(new_size, Image.ANTIALIAS, reducing_gap=REDUCING_GAP)
+        image.close()
+        image = resized
+        resized_at = time.perf_counter()
+
+    # encode image object to png in memory and close it
+    try:
+        document = encode_png(image, encoder, source_format)
+    finally:
+        image.close()
+    stats = {'encoder': encoder, 'decode_time': decode_time,
+             'resize_time': resized_at - (start if decode_time is None else decoded_at),
+             'encode_time': time.perf_counter() - resized_at, 'bytes': len(document)}
+
+    return document, stats
+
+
+def encode_png(image, encoder, source_format):
+    if encoder == 'fast':
+        return save_png(image, compress_level=1)
+    if encoder == 'optimal':
+        return save_png(image, optimize=True)
+
+    # jpegs are photos which never have few enough colors for a palette
+    palette_image = None
+    if source_format != 'JPEG' and image.mode in ('RGB', 'RGBA'):
+        colors = image.getcolors(256)
+        if colors is not None:
+            palette_image = quantize_exact(image, len(colors))
+
+    if palette_image is None:
+        return encode_adaptive(image)
+    with palette_image:
+        return encode_adaptive(palette_image)
+
+
+def encode_adaptive(image):
+    # small images are cheap to optimize while large ones only get optimized if they need to shrink
+    optimized = image.size[0] * image.size[1] <= ADAPTIVE_OPTIMIZE_PIXELS
+    document = save_png(image, optimize=optimized)
+    if len(document) > STICKER_MAX_BYTES and not optimized:
+        document = save_png(image, optimize=True)
+
+    # as a last resort give up exact colors to fit telegram's sticker size limit
+    if len(document) > STICKER_MAX_BYTES and image.mode in ('RGB', 'RGBA'):
+        with image.quantize(colors=256, method=Image.FASTOCTREE) as palette_image:
+            document = save_png(palette_image, optimize=True)
+
+    return document
+
+
+def quantize_exact(image, colors):
+    # quantizers are only exact for some images so the palette is kept only if nothing changed
+    method = Image.FASTOCTREE if image.mode == 'RGBA' else Image.MEDIANCUT
+    palette_image = image.quantize(colors=colors, method=method)
+    with palette_image.convert(image.mode) as converted:
+        if ImageChops.difference(image, converted).getbbox() is None:
+            return palette_image
+    palette_image.close()
+    return None
+
+
+def save_png(image, **params):
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", **params)
+    return buffer.getvalue()
+
+
+def resize_sticker(image):
+    new_size = draft_sticker(image)
+
+    # large downscales are reduced by an integer factor first and only the rest is done with lanczos
+    return image.resize(new_size, Image.ANTIALIAS, reducing_gap=REDUCING_GAP)
+
+
+def draft_sticker(image):
+    new_size = sticker_size(*image.size)
+
+    # let jpegs decode straight to a fraction of their full size which is still larger than the sticker
+    image.draft(image.mode, (int(new_size[0] * REDUCING_GAP), int(new_size[1] * REDUCING_GAP)))
+    return new_size
+
+
+def sticker_size(width, height):
+    reference_length = max(width, height)
+    ratio = 512 / reference_length
+    new_width = width * ratio
+    new_height = height * ratio
+    # round up if new dimension has .999 or more
+    if new_width % 1 >= .999:
+        new_width = int(round(new_width))
+    else:
+        new_width = int(new_width)
+    if new_height % 1 >= .999:
+        new_height = int(round(new_height))
+    else:
+        new_height = int(new_height)
+
+    # very thin images would round down to nothing
+    return max(new_width, 1), max(new_height, 1)
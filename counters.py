@@ -0,0 +1,63 @@
+import itertools
+import json
+from threading import Lock, local
+
+from storage import write_atomic
+
+# each thread is given its own shard index the first time it touches a counter
+_thread = local()
+_thread_indexes = itertools.count()
+
+
+def thread_index():
+    try:
+        return _thread.index
+    except AttributeError:
+        _thread.index = next(_thread_indexes)
+        return _thread.index
+
+
+# counter split into shards with their own locks so concurrent threads rarely wait on each other
+class StripedCounter:
+    def __init__(self, value=0, shards=16):
+        self._shards = [0] * shards
+        self._shards[0] = value
+        self._locks = [Lock() for _ in range(shards)]
+
+    def add(self, amount=1):
+        index = thread_index() % len(self._shards)
+        with self._locks[index]:
+            self._shards[index] += amount
+
+    @property
+    def value(self):
+        return sum(self._shards)
+
+
+# named striped counters that are aggregated when read
+class Counters:
+    def __init__(self, values):
+        self._counters = {name: StripedCounter(value) for name, value in values.items()}
+
+    def add(self, name, amount=1):
+        self._counters[name].add(amount)
+
+    def value(self, name):
+        return self._counters[name].value
+
+    def values(self):
+        return {name: counter.value for name, counter in self._counters.items()}
+
+
+# counters saved to a file of their own that is only written when one of them has changed
+class FileCounters(Counters):
+    def __init__(self, path, values):
+        super().__init__(values)
+        self.path = path
+        self._saved = self.values()
+
+    def flush(self):
+        values = self.values()
+        if values != self._saved:
+            write_atomic(self.path, json.dumps(values, indent=4, sort_keys=True))
+            self._saved = values
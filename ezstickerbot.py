@@ -1,27 +1,50 @@
+import asyncio
 import codecs
+import glob
+import hashlib
 import json
 import logging
 import os
 import re
+import secrets
+import shutil
+import signal
 import sys
 import time
 import uuid
-from collections import Counter
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, partial, wraps
+from threading import Lock, Thread
+from types import MappingProxyType
 from io import BytesIO
 from urllib.parse import urlparse
 
-import requests
-import simplejson
-from datetime import datetime
 from PIL import Image
-from requests.exceptions import InvalidURL, HTTPError, RequestException, ConnectionError, Timeout, ConnectTimeout
-from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, \
-    InputTextMessageContent, InlineQueryResultCachedDocument
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultCachedDocument
 from telegram.error import TelegramError, TimedOut, BadRequest, Unauthorized
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, InlineQueryHandler, \
-    ChosenInlineResultHandler, CallbackContext
+    ChosenInlineResultHandler, CallbackContext, TypeHandler
 from telegram.ext.dispatcher import run_async
 
+from animation import DEADLINE_MARGIN, AnimationError, format_animation
+from asyncbot import AsyncBot, EventLoop
+from broadcast import Broadcast
+from cache import ConversionCache
+from conversion import ConversionEngine, ConversionFailed, EngineBusy
+from counters import Counters, FileCounters
+from fetcher import Fetcher, FetchError
+from ingest import WebhookServer, save_pending_updates, load_pending_updates
+from localization import Catalog
+from metrics import Counter, Gauge, Histogram, MetricsServer, Registry
+from profiler import Profiler
+from ratelimit import RateLimiter
+from reloader import DEFAULT_CONFIG, FileWatcher, RESTART_KEYS, validate_config
+from sessions import SessionStore
+from state import SharedState, open_sqlite_state, open_redis_state
+from storage import SqliteUserStore, JournalUserStore, write_atomic
+from workers import WorkerPool
+
 directory = os.path.dirname(__file__)
 
 # set up logging
@@ -29,31 +52,187 @@ log_formatter = logging.Formatter("\n%(asctime)s [%(name)s] [%(levelname)s] %(me
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-file_handler = logging.FileHandler(os.path.join(directory, "ez-sticker-bot.log"))
-file_handler.setFormatter(log_formatter)
-logger.addHandler(file_handler)
+# opened by load_files once the directory the bot keeps its files in is known
+file_handler: logging.FileHandler = None
 
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setFormatter(log_formatter)
 logger.addHandler(console_handler)
 
 bot: Bot = None
+updater: Updater = None
+
+# seconds each long poll for updates waits, a restart waits for the one running to end before confirming updates
+POLL_TIMEOUT = 10
+
+# conversions run as coroutines on the event loop and talk to telegram through async_bot
+event_loop: EventLoop = None
+async_bot: AsyncBot = None
 
 config = {}
-users = {}
-lang = {}
+users: SqliteUserStore = None
+
+# counters kept in counters.json or the shared state, never in config.json
+COUNTER_NAMES = ('uses', 'times_shared', 'langs_auto_set')
+counters: Counters = None
+
+catalog: Catalog = None
+
+# notices edits to config.json and lang.json so they can be reloaded without a restart
+file_watcher: FileWatcher = None
+reload_lock = Lock()
+
+# per user flags such as make_icon that have to survive restarts
+sessions: SessionStore = None
+
+broadcast_thread = None
+
+rate_limiter: RateLimiter = None
+
+# counters and spam filter every worker process shares, not set when they are kept in this process
+shared_state: SharedState = None
+
+# index of this worker when running as one of several worker processes
+worker_index = None
+# workers updates are routed to when this is the process receiving them
+worker_pool: WorkerPool = None
+
+# bump whenever the output of format_image or format_animation changes so cached conversions are not reused
+PIPELINE_VERSION = 3
+conversion_cache: ConversionCache = None
+conversion_engine: ConversionEngine = None
+
+# documents with these types are made into video stickers
+ANIMATION_MIME_TYPES = ('image/gif', 'video/mp4', 'video/webm')
+
+# path of ffmpeg, animations can only be made into video stickers when it was found
+ffmpeg_path = None
+
+fetcher: Fetcher = None
+
+# only set when updates are received by webhook instead of polling
+webhook_server: WebhookServer = None
 
-recent_uses = {}
+# metrics served to prometheus, gauges are only read when they are scraped
+metrics_registry = Registry()
+stage_seconds = metrics_registry.add(Histogram('ezstickerbot_stage_seconds',
+                                               "Time taken by each stage of making a sticker", ('stage',)))
+save_seconds = metrics_registry.add(Histogram('ezstickerbot_save_seconds', "Time taken to save state"))
+spam_rejections = metrics_registry.add(Counter('ezstickerbot_spam_rejections_total',
+                                               "Uses refused by the spam filter"))
+cache_requests = metrics_registry.add(Counter('ezstickerbot_conversion_cache_requests_total',
+                                              "Conversion cache lookups by result", ('result',)))
+metrics_server: MetricsServer = None
+
+# only set when handlers are profiled
+profiler: Profiler = None
 
 
 def main():
     load_files()
 
-    updater = Updater(config['token'], use_context=True, workers=10)
-    dispatcher = updater.dispatcher
+    updater = create_updater()
+    if config['worker_processes'] > 1:
+        # every worker has to reach the same users, counters and spam filter
+        if config['user_store'] != 'sqlite' or config['shared_state'] == 'local':
+            sys.exit("worker_processes needs the sqlite user_store and a sqlite or redis shared_state; exiting")
+
+        # this process only receives updates and hands each one to the worker of its user
+        global worker_pool
+        worker_pool = WorkerPool(config['worker_processes'], run_worker)
+        worker_pool.start()
+        updater.dispatcher.add_handler(TypeHandler(Update, route_update))
+        updater.dispatcher.add_error_handler(handle_error)
+        # users this process registers while replying to commands are written like the workers' are
+        updater.job_queue.run_repeating(flush_users, config['save_interval'], config['save_interval'])
+    else:
+        start_handling(updater)
+    start_metrics(updater)
+
+    # handle updates that were waiting when the bot last restarted before any new ones
+    for path in pending_updates_paths():
+        for update in load_pending_updates(path, bot):
+            updater.update_queue.put(update)
+
+    if config['update_mode'] == 'webhook':
+        start_webhook(updater)
+    else:
+        updater.start_polling(clean=config['drop_pending_updates'], timeout=POLL_TIMEOUT)
+
+    print("Bot finished starting")
+
+    updater.idle()
+
+    if worker_pool is not None:
+        worker_pool.stop(config['shutdown_timeout'])
+        users.flush()
+    else:
+        # finish and save what was handled before the stop like a restart does
+        stop_handling()
+
+
+def run_worker(index, updates):
+    # ctrl+c reaches every process so leave stopping the workers to the process routing updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    global worker_index
+    worker_index = index
+    load_files()
+
+    updater = create_updater()
+    start_handling(updater)
+    start_metrics(updater)
+    start_dispatcher(updater)
+
+    while True:
+        update = updates.get()
+        if update is None:
+            break
+        updater.update_queue.put(Update.de_json(update, bot))
+
+    # save the updates this worker hasn't handled yet for whichever worker gets them after the restart
+    save_pending_updates(updater.update_queue, pending_updates_path(), 0)
+    updater.stop()
+    stop_handling()
+
+
+def create_updater():
+    global updater
+    updater = Updater(config['token'], base_url=config['telegram_base_url'],
+                      base_file_url=config['telegram_base_file_url'], use_context=True, workers=10)
     global bot
     bot = updater.bot
 
+    global event_loop, async_bot
+    event_loop = EventLoop()
+    event_loop.start()
+    async_bot = AsyncBot(config['token'], config['telegram_max_connections'], config['telegram_timeout'],
+                         config['telegram_base_url'], config['telegram_base_file_url'])
+
+    return updater
+
+
+def start_handling(updater):
+    global conversion_engine
+    conversion_engine = ConversionEngine(config['conversion_workers'], config['conversion_max_queue'],
+                                         config['conversion_timeout'], config['conversion_recycle_after'],
+                                         config['png_encoder'])
+
+    global fetcher
+    fetcher = Fetcher(config['max_file_size'], config['url_timeout'], config['url_max_per_host'],
+                      config['url_failure_ttl'], config['url_pool_size'])
+
+    global ffmpeg_path
+    ffmpeg_path = shutil.which(config['ffmpeg_path'])
+    if ffmpeg_path is None:
+        logger.warning("Couldn't find ffmpeg at '{}' so animations won't be made into stickers".format(
+            config['ffmpeg_path']))
+
+    dispatcher = updater.dispatcher
+
+    # register users before any other handler sees their update
+    dispatcher.add_handler(TypeHandler(Update, register_update_user), group=-1)
+
     # register a handler to ignore all non-private updates
     dispatcher.add_handler(MessageHandler(~ Filters.private, do_fucking_nothing))
 
@@ -67,6 +246,8 @@ def main():
     dispatcher.add_handler(CommandHandler('langstats', lang_stats_command))
     dispatcher.add_handler(CommandHandler('log', log_command))
     dispatcher.add_handler(CommandHandler(['optin', 'optout'], opt_command))
+    dispatcher.add_handler(CommandHandler('profile', profile_command))
+    dispatcher.add_handler(CommandHandler('reload', reload_command))
     dispatcher.add_handler(CommandHandler('restart', restart_command))
     dispatcher.add_handler(CommandHandler('start', start_command))
     dispatcher.add_handler(CommandHandler('stats', stats_command))
@@ -75,6 +256,7 @@ def main():
     dispatcher.add_handler(MessageHandler(Filters.command, invalid_command))
 
     # register media listener
+    dispatcher.add_handler(MessageHandler((Filters.animation | Filters.video), animation_received))
     dispatcher.add_handler(MessageHandler((Filters.photo | Filters.document), image_received))
     dispatcher.add_handler(MessageHandler(Filters.sticker, sticker_received))
     dispatcher.add_handler(MessageHandler(Filters.text, url_received))
@@ -91,17 +273,112 @@ def main():
 
     dispatcher.add_handler(ChosenInlineResultHandler(inline_result_chosen))
 
+    # time every handler and keep the slowest updates when profiling is turned on
+    if config['profile_threshold']:
+        global profiler
+        profiler = Profiler(config['profile_threshold'], config['profile_top'], config['profile_sample_interval'])
+        profiler.start()
+        profile_handlers(dispatcher)
+
+    # resume a broadcast that was interrupted by a restart, with several workers only the first one resumes it
+    state = Broadcast.load_state(broadcast_state_path())
+    if state is not None and not worker_index:
+        global broadcast_thread
+        broadcast_thread = Broadcast(bot, users, get_message, config, broadcast_state_path(), state).start()
+
     # register variable dump loop
     updater.job_queue.run_repeating(save_files, config['save_interval'], config['save_interval'])
 
+    # register loop reloading config.json and lang.json when they are edited
+    updater.job_queue.run_repeating(reload_changed_files, config['reload_interval'], config['reload_interval'])
+
     # register error handler
     dispatcher.add_error_handler(handle_error)
 
-    updater.start_polling(clean=True, timeout=99999)
 
-    print("Bot finished starting")
+def profile_handlers(dispatcher):
+    # handlers that run in a thread or on the event loop are profiled where they actually run
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            func = getattr(handler.callback, '__wrapped__', None)
+            if func is None:
+                handler.callback = profiler.wrap(handler.callback)
+            elif asyncio.iscoroutinefunction(func):
+                handler.callback = run_on_loop(profiler.wrap_coroutine(func))
+            else:
+                handler.callback = run_async(profiler.wrap(func))
 
-    updater.idle()
+
+def stop_handling():
+    # let conversions that are already running finish before saving
+    event_loop.wait(config['shutdown_timeout'])
+    save_files()
+    event_loop.run(close_clients())
+    conversion_engine.shutdown()
+
+
+def start_metrics(updater):
+    if not config['metrics_port']:
+        return
+
+    metrics_registry.add(Gauge('ezstickerbot_update_queue_depth', "Updates waiting for the dispatcher",
+                               updater.update_queue.qsize))
+    metrics_registry.add(Gauge('ezstickerbot_jobs', "Jobs scheduled in the job queue",
+                               lambda: len(updater.job_queue.jobs())))
+    metrics_registry.add(Gauge('ezstickerbot_counter', "Totals kept by the bot", counters.values, 'name'))
+    if worker_pool is not None:
+        metrics_registry.add(Gauge('ezstickerbot_worker_queue_depth', "Updates routed to each worker not taken yet",
+                                   worker_pool.depths, 'worker'))
+    if conversion_engine is not None:
+        metrics_registry.add(Gauge('ezstickerbot_conversions_pending', "Conversions queued or running",
+                                   lambda: conversion_engine.pending))
+        metrics_registry.add(Gauge('ezstickerbot_conversion_cache_size', "Conversions kept in the cache",
+                                   lambda: len(conversion_cache)))
+
+    # each worker serves its own metrics on the ports following the one of the process routing updates
+    port = config['metrics_port'] if worker_index is None else config['metrics_port'] + 1 + worker_index
+
+    global metrics_server
+    metrics_server = MetricsServer(metrics_registry, config['metrics_listen'], port)
+    event_loop.run(metrics_server.start())
+
+
+def route_update(update: Update, context: CallbackContext):
+    message = update.message
+    command = None
+    if message is not None and message.text:
+        command = message.text.split()[0].split('@')[0]
+
+    # restarts are handled here since they restart every worker along with this process
+    if command == '/restart':
+        restart_command(update, context)
+    # broadcasts only run in the first worker so only one can run at a time
+    elif command == '/broadcast':
+        worker_pool.route(update, 0)
+    else:
+        worker_pool.route(update)
+
+
+def start_webhook(updater):
+    # a random secret is used when none is configured since telegram is given it again on every start
+    secret_token = config['webhook_secret'] or secrets.token_urlsafe(32)
+
+    global webhook_server
+    webhook_server = WebhookServer(bot, updater.update_queue, config['webhook_listen'], config['webhook_port'],
+                                   urlparse(config['webhook_url']).path, secret_token)
+    event_loop.run(webhook_server.start())
+    event_loop.run(async_bot.call('setWebhook', url=config['webhook_url'], secret_token=secret_token,
+                                  max_connections=config['webhook_max_connections'],
+                                  drop_pending_updates=config['drop_pending_updates']))
+
+    start_dispatcher(updater)
+
+
+def start_dispatcher(updater):
+    # start what start_polling would have started and mark the updater running so idle can stop it
+    updater.job_queue.start()
+    Thread(target=updater.dispatcher.start, name="dispatcher", daemon=True).start()
+    updater.running = True
 
 
 #   ____
@@ -110,158 +387,216 @@ def main():
 # | |___  | (_) | | |    |  __/
 #  \____|  \___/  |_|     \___|
 
-@run_async
-def image_received(update: Update, context: CallbackContext):
+def run_on_loop(func):
+    # like run_async but runs the handler as a coroutine on the event loop instead of in a worker thread
+    @wraps(func)
+    def schedule(update: Update, context: CallbackContext):
+        event_loop.submit(func(update, context))
+
+    return schedule
+
+
+async def in_thread(func, *args):
+    # the user store, sessions and spam filter can block on sqlite or redis so coroutines use them from a thread
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def close_clients():
+    await async_bot.close()
+    if fetcher is not None:
+        await fetcher.close()
+
+
+@run_on_loop
+async def image_received(update: Update, context: CallbackContext):
     message = update.message
     user_id = message.from_user.id
+    messages = await in_thread(user_messages, user_id)
 
     # check spam filter
-    cooldown_info = user_on_cooldown(user_id)
+    cooldown_info = await in_thread(user_on_cooldown, user_id)
     if cooldown_info[0]:
         minutes = int(config['spam_interval'] / 60)
-        message_text = get_message(user_id, 'spam_limit_reached').format(config['spam_max'], minutes, cooldown_info[1],
-                                                                         cooldown_info[2])
-        message.reply_markdown(message_text)
+        message_text = messages['spam_limit_reached'].format(config['spam_max'], minutes, cooldown_info[1],
+                                                             cooldown_info[2])
+        await async_bot.send_message(message.chat_id, message_text, parse_mode='Markdown')
         return
 
     # get file id
     if message.document:
         # check that document is image
         document = message.document
-        if document.mime_type.lower() in ('image/png', 'image/jpeg', 'image/webp'):
+        mime_type = (document.mime_type or '').lower()
+        if mime_type in ANIMATION_MIME_TYPES:
+            await create_animation_sticker(message, document, context)
+            return
+        if mime_type in ('image/png', 'image/jpeg', 'image/webp'):
             photo_id = document.file_id
         else:
             # feedback to show bot is processing
-            bot.send_chat_action(user_id, 'typing')
+            await async_bot.send_chat_action(user_id, 'typing')
 
-            message.reply_markdown(get_message(user_id, 'doc_not_img'))
+            await async_bot.send_message(message.chat_id, messages['doc_not_img'], parse_mode='Markdown')
             return
         # check that document is not too large
         if document.file_size > config['max_file_size']:
             # feedback to show bot is processing
-            bot.send_chat_action(user_id, 'typing')
+            await async_bot.send_chat_action(user_id, 'typing')
 
-            message.reply_text(get_message(user_id, 'file_too_large'))
+            await async_bot.send_message(message.chat_id, messages['file_too_large'])
             return
     else:
-        photo_id = message.photo[-1].file_id
+        document = message.photo[-1]
+        photo_id = document.file_id
 
     # feedback to show bot is processing
-    bot.send_chat_action(user_id, 'upload_document')
+    await async_bot.send_chat_action(user_id, 'upload_document')
 
+    animated = False
+    get_content = partial(download_file, photo_id)
     try:
-        download_path = download_file(photo_id)
-        image = Image.open(download_path)
+        # webps are only made into video stickers when pillow finds more than one frame in them, so they are
+        # downloaded before looking for an earlier conversion
+        if message.document is not None and mime_type == 'image/webp' and ffmpeg_path is not None:
+            content = await download_file(photo_id)
+            try:
+                with Image.open(BytesIO(content)) as image:
+                    animated = getattr(image, 'is_animated', False)
+            # converting it tells the user it can't be used
+            except OSError:
+                pass
+
+            async def get_content():
+                return content
+
+        await create_sticker_file(message, document.file_unique_id, get_content, context, animated)
+    except TelegramError:
+        await async_bot.send_message(message.chat_id, messages["send_timeout"])
+
+
+@run_on_loop
+async def animation_received(update: Update, context: CallbackContext):
+    message = update.message
+    user_id = message.from_user.id
+    messages = await in_thread(user_messages, user_id)
+
+    # check spam filter
+    cooldown_info = await in_thread(user_on_cooldown, user_id)
+    if cooldown_info[0]:
+        minutes = int(config['spam_interval'] / 60)
+        message_text = messages['spam_limit_reached'].format(config['spam_max'], minutes, cooldown_info[1],
+                                                             cooldown_info[2])
+        await async_bot.send_message(message.chat_id, message_text, parse_mode='Markdown')
+        return
+
+    # gifs are sent as animations and videos as videos
+    await create_animation_sticker(message, message.animation or message.video, context)
+
 
-        create_sticker_file(message, image, context)
+async def create_animation_sticker(message, document, context: CallbackContext):
+    user_id = message.from_user.id
+    messages = await in_thread(user_messages, user_id)
+
+    # check that animations can be encoded and the file is not too large
+    if ffmpeg_path is None or document.file_size is not None and document.file_size > config['max_file_size']:
+        # feedback to show bot is processing
+        await async_bot.send_chat_action(user_id, 'typing')
+
+        reason = 'animations_unsupported' if ffmpeg_path is None else 'file_too_large'
+        await async_bot.send_message(message.chat_id, messages[reason])
+        return
+
+    # feedback to show bot is processing
+    await async_bot.send_chat_action(user_id, 'upload_document')
 
-        # delete local file
-        os.remove(download_path)
+    try:
+        await create_sticker_file(message, document.file_unique_id, lambda: download_file(document.file_id), context,
+                                  True)
     except TimedOut:
-        message.reply_text(get_message(user_id, "send_timeout"))
-    except FileNotFoundError:
-        # if file does not exist ignore
-        pass
+        await async_bot.send_message(message.chat_id, messages["send_timeout"])
 
 
-@run_async
-def sticker_received(update: Update, context: CallbackContext):
+@run_on_loop
+async def sticker_received(update: Update, context: CallbackContext):
     message = update.message
     user_id = message.from_user.id
+    messages = await in_thread(user_messages, user_id)
 
     # check spam filter
-    cooldown_info = user_on_cooldown(user_id)
+    cooldown_info = await in_thread(user_on_cooldown, user_id)
     if cooldown_info[0]:
         minutes = int(config['spam_interval'] / 60)
-        message_text = get_message(user_id, 'spam_limit_reached').format(config['spam_max'], minutes, cooldown_info[1],
-                                                                         cooldown_info[2])
-        message.reply_markdown(message_text)
+        message_text = messages['spam_limit_reached'].format(config['spam_max'], minutes, cooldown_info[1],
+                                                             cooldown_info[2])
+        await async_bot.send_message(message.chat_id, message_text, parse_mode='Markdown')
         return
 
     # check if sticker is animated
     if message.sticker.is_animated:
-        animated_sticker_received(update, context)
+        await animated_sticker_received(update, context)
         return
 
     sticker_id = message.sticker.file_id
 
     # feedback to show bot is processing
-    bot.send_chat_action(user_id, 'upload_document')
+    await async_bot.send_chat_action(user_id, 'upload_document')
 
     try:
-        download_path = download_file(sticker_id)
-
-        image = Image.open(download_path)
-        create_sticker_file(message, image, context)
-
-        # delete local file
-        os.remove(download_path)
+        await create_sticker_file(message, message.sticker.file_unique_id,
+                                  lambda: download_file(sticker_id), context)
     except Unauthorized:
         pass
     except TelegramError:
-        message.reply_text(get_message(user_id, "send_timeout"))
-    except FileNotFoundError:
-        # if file does not exist ignore
-        pass
+        await async_bot.send_message(message.chat_id, messages["send_timeout"])
 
 
-def animated_sticker_received(update: Update, context: CallbackContext):
+async def animated_sticker_received(update: Update, context: CallbackContext):
     message = update.message
     user_id = message.from_user.id
+    messages = await in_thread(user_messages, user_id)
 
     # feedback to show bot is processing
-    bot.send_chat_action(user_id, 'upload_document')
+    await async_bot.send_chat_action(user_id, 'upload_document')
 
     sticker_id = message.sticker.file_id
 
     # download sticker and send as document
     try:
-        download_path = download_file(sticker_id)
-
-        document = open(download_path, 'rb')
-        sticker_message = message.reply_document(document=document)
-        sent_message = sticker_message.reply_markdown(get_message(user_id, "forward_animated_sticker"), quote=True)
+        document = await download_file(sticker_id)
+        sticker_message = await async_bot.send_document(message.chat_id, document, filename='sticker.tgs')
 
-        # add a keyboard with a forward button to the document
-        file_id = sticker_message.sticker.file_id
+        # reply with a keyboard with a forward button to the document
+        file_id = sticker_message['sticker']['file_id']
         markup = InlineKeyboardMarkup(
-            [[InlineKeyboardButton(get_message(user_id, "forward"), switch_inline_query=file_id)]])
-        sent_message.edit_reply_markup(reply_markup=markup)
-
-        # delete local file
-        os.remove(download_path)
+            [[InlineKeyboardButton(messages["forward"], switch_inline_query=file_id)]])
+        await async_bot.send_message(message.chat_id, messages["forward_animated_sticker"],
+                                     parse_mode='Markdown', reply_to_message_id=sticker_message['message_id'],
+                                     reply_markup=markup)
     except TelegramError:
-        message.reply_text(get_message(user_id, "send_timeout"))
-    except FileNotFoundError:
-        # if file does not exist ignore
-        pass
+        await async_bot.send_message(message.chat_id, messages["send_timeout"])
 
-    # record use in spam filter
-    record_use(user_id, context)
+    uses = await in_thread(count_use, user_id)
+    await donate_suggest(user_id, uses, messages)
 
-    # increase total uses count by one
-    global config
-    config['uses'] += 1
-    global users
-    users[str(user_id)]['uses'] += 1
 
-    donate_suggest(user_id)
-
-
-@run_async
-def url_received(update: Update, context: CallbackContext):
+@run_on_loop
+async def url_received(update: Update, context: CallbackContext):
     message = update.message
     user_id = message.from_user.id
+    messages = await in_thread(user_messages, user_id)
     text = message.text.split(' ')
 
     # check spam filter
-    cooldown_info = user_on_cooldown(user_id)
+    cooldown_info = await in_thread(user_on_cooldown, user_id)
     if cooldown_info[0]:
-        message.reply_markdown(get_message(user_id, 'spam_limit_reached').format(cooldown_info[1], cooldown_info[2]))
+        minutes = int(config['spam_interval'] / 60)
+        message_text = messages['spam_limit_reached'].format(config['spam_max'], minutes, cooldown_info[1],
+                                                             cooldown_info[2])
+        await async_bot.send_message(message.chat_id, message_text, parse_mode='Markdown')
         return
 
     if len(text) > 1:
-        message.reply_text(get_message(message.chat_id, "too_many_urls"))
+        await async_bot.send_message(message.chat_id, messages["too_many_urls"])
         return
 
     text = text[0]
@@ -271,134 +606,141 @@ def url_received(update: Update, context: CallbackContext):
     if url.lower().startswith("https:///"):
         url = url.replace("https:///", "https://", 1)
 
-    # get request
+    # download the file in a single request that stops once it is too large or clearly not an image
     try:
-        # check that file is not too big
-        head = requests.head(url, timeout=3)
-        if int(head.headers['Content-length']) > config['max_file_size']:
+        with stage_seconds.time('download'):
+            content = await fetcher.fetch(url)
+    except FetchError as e:
+        if e.reason == 'file_too_large':
             # feedback to show bot is processing
-            bot.send_chat_action(user_id, 'typing')
+            await async_bot.send_chat_action(user_id, 'typing')
 
-            message.reply_text(get_message(user_id, 'file_too_large'))
-            return
-
-        request = requests.get(url, timeout=3)
-        request.raise_for_status()
-    except InvalidURL:
-        message.reply_markdown(get_message(message.chat_id, "invalid_url").format(url))
-        return
-    except HTTPError:
-        message.reply_markdown(get_message(message.chat_id, "url_does_not_exist").format(url))
-        return
-    except Timeout or ConnectTimeout:
-        message.reply_markdown(get_message(message.chat_id, "url_timeout").format(url))
-        return
-    except ConnectionError or RequestException or UnicodeError:
-        message.reply_markdown(get_message(message.chat_id, "unable_to_connect").format(url))
-        return
-    except UnicodeError:
-        message.reply_markdown(get_message(message.chat_id, "unable_to_connect").format(url))
+            await async_bot.send_message(message.chat_id, messages['file_too_large'])
+        else:
+            await async_bot.send_message(message.chat_id, messages[e.reason].format(url),
+                                         parse_mode='Markdown')
         return
 
-    # read image from url
+    # check that content from url is an image
     try:
-        image = Image.open(BytesIO(request.content))
+        with Image.open(BytesIO(content)) as image:
+            # animated gifs and webps are made into video stickers when ffmpeg is there to encode them
+            animated = getattr(image, 'is_animated', False) and ffmpeg_path is not None
     except OSError:
-        message.reply_markdown(get_message(message.chat_id, "url_not_img").format(url))
+        await async_bot.send_message(message.chat_id, messages["url_not_img"].format(url),
+                                     parse_mode='Markdown')
         return
 
     # feedback to show bot is processing
-    bot.send_chat_action(message.chat_id, 'upload_document')
+    await async_bot.send_chat_action(message.chat_id, 'upload_document')
 
-    create_sticker_file(message, image, context)
+    async def get_content():
+        return content
 
+    # images from urls are identified by a hash of their content
+    source_id = hashlib.sha1(content).hexdigest()
+    await create_sticker_file(message, source_id, get_content, context, animated)
 
-def create_sticker_file(message, image, context: CallbackContext):
-    user_id = message.from_user.id
-    user_data = context.user_data
 
-    # set make_icon if not already set
-    if 'make_icon' not in user_data:
-        user_data['make_icon'] = False
-
-    # if user is making icon
-    if user_data['make_icon']:
-        image.thumbnail((100, 100), Image.ANTIALIAS)
-        background = Image.new('RGBA', (100, 100), (255, 255, 255, 0))
-        background.paste(image, (int(((100 - image.size[0]) / 2)), int(((100 - image.size[1]) / 2))))
-        image = background
-
-    # else format image to sticker
-    else:
-        width, height = image.size
-        reference_length = max(width, height)
-        ratio = 512 / reference_length
-        new_width = width * ratio
-        new_height = height * ratio
-        # round up if new dimension has .999 or more
-        if new_width % 1 >= .999:
-            new_width = int(round(new_width))
-        else:
-            new_width = int(new_width)
-        if new_height % 1 >= .999:
-            new_height = int(round(new_height))
-        else:
-            new_height = int(new_height)
-
-        image = image.resize((new_width, new_height), Image.ANTIALIAS)
+async def create_sticker_file(message, source_id, get_image_data, context: CallbackContext, animated=False):
+    user_id = message.from_user.id
+    messages = await in_thread(user_messages, user_id)
+    make_icon = await in_thread(sessions.get, user_id, 'make_icon', False)
 
-    # save image object to temporary file
-    temp_path = os.path.join(temp_dir(), (uuid.uuid4().hex[:6].upper() + '.png'))
-    image.save(temp_path, format="PNG", optimize=True)
+    # reuse the file from an earlier identical conversion if there is one
+    mode = 'icon' if make_icon else 'video' if animated else 'sticker'
+    cache_key = ConversionCache.key(source_id, mode, PIPELINE_VERSION, conversion_engine.encoder)
+    document = conversion_cache.get(cache_key)
+    cache_requests.inc('miss' if document is None else 'hit')
 
-    # send formatted image as a document
-    document = open(temp_path, 'rb')
+    # send formatted image as a document, the name only matters for new files as telegram keeps the name of cached ones
+    filename = mode + '.png'
     try:
-        filename = 'icon.png' if user_data['make_icon'] else 'sticker.png'
-        sent_message = message.reply_document(document=document, filename=filename,
-                                              caption=get_message(user_id, "forward_to_stickers"), quote=True,
-                                              timeout=30)
+        if document is None:
+            document, filename = await convert_image(await get_image_data(), make_icon, animated)
+        try:
+            sent_message = await reply_sticker_document(message, document, filename, messages)
+        except BadRequest:
+            if not isinstance(document, str):
+                raise
+            # cached file_id is no longer accepted so drop it and convert the image again
+            conversion_cache.discard(cache_key)
+            document, filename = await convert_image(await get_image_data(), make_icon, animated)
+            sent_message = await reply_sticker_document(message, document, filename, messages)
+
         # add a keyboard with a forward button to the document
-        file_id = sent_message.document.file_id
+        file_id = sent_message['document']['file_id']
+        conversion_cache.put(cache_key, file_id)
         markup = InlineKeyboardMarkup(
-            [[InlineKeyboardButton(get_message(user_id, "forward"), switch_inline_query=file_id)]])
-        sent_message.edit_reply_markup(reply_markup=markup)
+            [[InlineKeyboardButton(messages["forward"], switch_inline_query=file_id)]])
+        with stage_seconds.time('edit_reply_markup'):
+            await async_bot.edit_message_reply_markup(message.chat_id, sent_message['message_id'], markup)
+    # conversion engine is at capacity, the conversion took too long or a worker process died
+    except (EngineBusy, futures.TimeoutError, BrokenProcessPool):
+        await async_bot.send_message(message.chat_id, messages["busy"])
+        return
+    except AnimationError as e:
+        if e.detail:
+            logger.warning("Couldn't make animation into a sticker: {}".format(e.detail))
+        await async_bot.send_message(message.chat_id, messages[e.reason])
+        return
+    # the image couldn't be converted in the worker
+    except ConversionFailed:
+        logger.warning("Couldn't convert image", exc_info=True)
+        await async_bot.send_message(message.chat_id, messages["cant_process"])
+        return
     except Unauthorized:
         pass
     except TelegramError:
-        message.reply_text(get_message(user_id, "send_timeout"))
-
-    # delete local files and close image object
-    image.close()
-    os.remove(temp_path)
+        await async_bot.send_message(message.chat_id, messages["send_timeout"])
 
     # remove user from make_icon if icon was created
-    if user_data['make_icon']:
-        user_data['make_icon'] = False
-
-    # record use in spam filter
-    record_use(user_id, context)
+    if make_icon:
+        await in_thread(sessions.set, user_id, 'make_icon', False)
 
-    # increase total uses count by one
-    global config
-    config['uses'] += 1
-    global users
-    users[str(user_id)]['uses'] += 1
+    uses = await in_thread(count_use, user_id)
+    await donate_suggest(user_id, uses, messages)
 
-    donate_suggest(user_id)
 
+async def download_file(file_id):
+    with stage_seconds.time('get_file'):
+        file = await async_bot.get_file(file_id)
+    with stage_seconds.time('download'):
+        return await async_bot.download(file['file_path'])
 
-def download_file(file_id):
-    try:
-        # download file
-        file = bot.get_file(file_id=file_id, timeout=30)
-        ext = '.' + file.file_path.split('/')[-1].split('.')[1]
-        download_path = os.path.join(temp_dir(), (file_id + ext))
-        file.download(custom_path=download_path)
 
-        return download_path
-    except TimedOut:
-        raise TimedOut
+async def convert_image(data, make_icon, animated=False):
+    # conversion includes waiting for a worker process on top of the stages timed inside it
+    with stage_seconds.time('convert'):
+        if animated:
+            # ffmpeg has until just before the engine stops waiting for the job, time spent queued included
+            deadline = time.time() + conversion_engine.timeout - DEADLINE_MARGIN
+            document, stats = await conversion_engine.run(format_animation, data, make_icon, conversion_engine.encoder,
+                                                          ffmpeg_path, config['animation_max_pixels'],
+                                                          config['animation_memory_limit'], deadline)
+        else:
+            document, stats = await conversion_engine.convert(data, make_icon)
+    if stats.get('animated'):
+        logger.debug("Encoded webm at {}kbps to {:,} bytes".format(stats['bitrate'], stats['bytes']))
+        return document, 'sticker.webm'
+
+    if stats['decode_time'] is not None:
+        stage_seconds.observe(stats['decode_time'], 'decode')
+    stage_seconds.observe(stats['resize_time'], 'resize')
+    stage_seconds.observe(stats['encode_time'], 'encode')
+    logger.debug("Encoded png with {} encoder in {:.1f}ms to {:,} bytes".format(stats['encoder'],
+                                                                             stats['encode_time'] * 1000,
+                                                                             stats['bytes']))
+    return document, ('icon' if make_icon else 'sticker') + '.png'
+
+
+async def reply_sticker_document(message, document, filename, messages):
+    # telegram would otherwise send an uploaded webm as a video instead of a document
+    with stage_seconds.time('upload'):
+        return await async_bot.send_document(message.chat_id, document, filename=filename,
+                                             caption=messages["forward_to_stickers"],
+                                             reply_to_message_id=message.message_id,
+                                             disable_content_type_detection=True)
 
 
 #  _____                          _       _   _                       _   _
@@ -413,8 +755,7 @@ def change_lang_callback(update: Update, context: CallbackContext):
     lang_code = query.data.split(':')[-1]
     user_id = str(query.from_user.id)
 
-    global users
-    users[user_id]['lang'] = lang_code
+    users.set(user_id, 'lang', lang_code)
 
     # replace instances of $userid with username or name if no username
     message = get_message(user_id, "lang_set").split(' ')
@@ -423,9 +764,7 @@ def change_lang_callback(update: Update, context: CallbackContext):
         if word[0] == '$':
             try:
                 _id = int(''.join(c for c in word if c.isdigit()))
-                user = bot.get_chat(_id)
-                message[i] = '<a href="tg://user?id={}">{}{}</a>'.format(_id, user.first_name,
-                                                                         ' ' + user.last_name if user.last_name else '')
+                message[i] = user_mention(_id)
             except ValueError:
                 message[i] = 'UNKNOWN_USER_ID'
                 continue
@@ -435,7 +774,7 @@ def change_lang_callback(update: Update, context: CallbackContext):
     message = ' '.join(message)
 
     # set icon_warned to false
-    users[user_id]['icon_warned'] = False
+    users.set(user_id, 'icon_warned', False)
 
     query.edit_message_text(text=message, reply_markup=None, parse_mode='HTML')
     query.answer()
@@ -446,17 +785,8 @@ def share_query_received(update: Update, context: CallbackContext):
     query = update.inline_query
     user_id = query.from_user.id
 
-    # get labels in user's language
-    title = get_message(user_id, "share")
-    description = get_message(user_id, "share_desc")
-    thumb_url = config['share_thumb_url']
-    markup = InlineKeyboardMarkup(
-        [[InlineKeyboardButton(text=get_message(user_id, "make_sticker_button"), url="https://t.me/EzStickerBot")]])
-    input_message_content = InputTextMessageContent(get_message(user_id, "share_text"), parse_mode='Markdown')
-
-    # build response and answer query
-    results = [InlineQueryResultArticle(id="share", title=title, description=description, thumb_url=thumb_url,
-                                        reply_markup=markup, input_message_content=input_message_content)]
+    # get response in user's language and answer query
+    results = catalog.share_results[get_user_config(user_id, "lang")]
     try:
         query.answer(results=results, cache_time=5, is_personal=True)
     # if user waited too long to click result BadRequest is thrown
@@ -495,8 +825,8 @@ def icon_cancel_callback(update: Update, context: CallbackContext):
     query = update.callback_query
     user_id = str(query.from_user.id)
 
-    # set make_icon in user_data to false
-    context.user_data['make_icon'] = False
+    # set make_icon in the user's session to false
+    sessions.set(user_id, 'make_icon', False)
 
     query.edit_message_text(text=get_message(user_id, "icon_canceled"), reply_markup=None)
     query.answer()
@@ -507,10 +837,9 @@ def inline_result_chosen(update: Update, context: CallbackContext):
     chosen_result = update.chosen_inline_result
     result_id = chosen_result.result_id
 
-    global config
     # if was a share increase count by one
     if result_id == 'share':
-        config['times_shared'] += 1
+        counters.add('times_shared')
 
 
 @run_async
@@ -569,26 +898,21 @@ def broadcast_command(update: Update, context: CallbackContext):
         message.reply_markdown(get_message(chat_id, "broadcast_only_text"))
         return
 
+    # only one broadcast can run at a time
+    global broadcast_thread
+    if broadcast_thread is not None and broadcast_thread.is_alive():
+        message.reply_text(get_message(chat_id, "broadcast_running"))
+        return
+
     message.reply_text(get_message(chat_id, "will_broadcast"))
-    context.job_queue.run_once(broadcast_thread, 2, context=broadcast_message)
+    state = Broadcast.new_state(broadcast_message, chat_id)
+    broadcast_thread = Broadcast(bot, users, get_message, config, broadcast_state_path(), state).start()
 
 
 @run_async
 def change_lang_command(update: Update, context: CallbackContext):
     message = update.message
-    ordered_langs = [None] * len(lang)
-    for lang_code in lang.keys():
-        ordered_langs[int(lang[lang_code]['order'])] = lang_code
-    keyboard = [[]]
-    row = 0
-    for lang_code in ordered_langs:
-        if len(keyboard[row]) == 3:
-            row += 1
-            keyboard.append([])
-        keyboard[row].append(
-            InlineKeyboardButton(lang[lang_code]['lang_name'], callback_data="lang:{}".format(lang_code)))
-    markup = InlineKeyboardMarkup(keyboard)
-    message.reply_text(get_message(message.chat_id, "select_lang"), reply_markup=markup)
+    message.reply_text(get_message(message.chat_id, "select_lang"), reply_markup=catalog.lang_keyboard)
 
 
 @run_async
@@ -615,21 +939,17 @@ def icon_command(update: Update, context: CallbackContext):
     # feedback to show bot is processing
     bot.send_chat_action(message.chat_id, 'typing')
 
-    # set make_icon to True in user_data
-    context.user_data['make_icon'] = True
+    # get keyboard with cancel button
+    markup = catalog.icon_keyboards[get_user_config(message.chat_id, "lang")]
 
-    # create keyboard with cancel button
-    keyboard = [[
-        InlineKeyboardButton(get_message(message.chat_id, "cancel"), callback_data="icon_cancel")
-    ]]
-    markup = InlineKeyboardMarkup(keyboard)
+    # set make_icon to True in the user's session
+    sessions.set(message.chat_id, 'make_icon', True)
 
     # if user has not been sent icon info message send it
     if not get_user_config(message.chat_id, 'icon_warned'):
         message.reply_markdown(get_message(message.chat_id, "icon_command_info"))
 
-        global users
-        users[str(message.chat_id)]['icon_warned'] = True
+        users.set(message.chat_id, 'icon_warned', True)
 
     message.reply_markdown(get_message(message.chat_id, "icon_command"), reply_markup=markup)
 
@@ -640,15 +960,8 @@ def info_command(update: Update, context: CallbackContext):
 
     # feedback to show bot is processing
     bot.send_chat_action(message.chat_id, 'typing')
-    keyboard = [
-        [InlineKeyboardButton(get_message(message.chat_id, "contact_dev"), url=config['contact_dev_link']),
-         InlineKeyboardButton(get_message(message.chat_id, "source"),
-                              url=config['source_link'])],
-        [InlineKeyboardButton(get_message(message.chat_id, "rate"),
-                              url=config['rate_link']),
-         InlineKeyboardButton(get_message(message.chat_id, "share"), switch_inline_query="share")]]
-    markup = InlineKeyboardMarkup(keyboard)
-    message.reply_markdown(get_message(message.chat_id, "info").format(config['uses']), reply_markup=markup)
+    markup = catalog.info_keyboards[get_user_config(message.chat_id, "lang")]
+    message.reply_markdown(get_message(message.chat_id, "info").format(counters.value('uses')), reply_markup=markup)
 
 
 @run_async
@@ -662,23 +975,13 @@ def lang_stats_command(update: Update, context: CallbackContext):
     lang_stats_message = get_message(message.chat_id, "lang_stats")
 
     # count lang usage
-    langs = [user['lang'] for user in users.values()]
-    lang_usage = dict(Counter(langs))
+    lang_usage = users.lang_counts()
 
     sorted_usage = [(code, lang_usage[code]) for code in sorted(lang_usage, key=lang_usage.get, reverse=True)]
 
     # create stats message entries
-    message_lines = {}
     for code, count in sorted_usage:
-        lang_stats_message += "\n" + u"\u200E" + "{}: {:,}".format(lang[code]['lang_name'], count)
-
-    # compile stats message in order
-    for index in range(0, len(lang)):
-        try:
-            lang_stats_message += message_lines[str(index)]
-        # Skip langs with 0 users
-        except KeyError:
-            continue
+        lang_stats_message += "\n" + u"\u200E" + "{}: {:,}".format(catalog.messages[code]['lang_name'], count)
 
     # send message
     message.reply_markdown(lang_stats_message)
@@ -710,6 +1013,32 @@ def log_command(update: Update, context: CallbackContext):
         message.reply_text(get_message(message.chat_id, "no_permission"))
 
 
+@run_async
+def profile_command(update: Update, context: CallbackContext):
+    message = update.message
+
+    # check if user is admin
+    if message.from_user.id in config['admins']:
+        # feedback to show bot is processing
+        bot.send_chat_action(message.chat_id, 'upload_document')
+
+        # send the slowest updates as a document like the log
+        if profiler is None:
+            message.reply_markdown(get_message(message.chat_id, "profiling_off"))
+            return
+        report = profiler.report()
+        if not report:
+            message.reply_text(get_message(message.chat_id, "no_slow_updates"))
+            return
+        message.reply_document(BytesIO(report.encode('utf-8')), filename='profile.txt')
+
+    else:
+        # feedback to show bot is processing
+        bot.send_chat_action(message.chat_id, 'typing')
+
+        message.reply_text(get_message(message.chat_id, "no_permission"))
+
+
 @run_async
 def opt_command(update: Update, context: CallbackContext):
     message = update.message
@@ -718,7 +1047,6 @@ def opt_command(update: Update, context: CallbackContext):
     bot.send_chat_action(message.chat_id, 'typing')
 
     # get user opt_in status
-    global users
     user_id = str(message.from_user.id)
     opt_in = get_user_config(user_id, "opt_in")
 
@@ -727,16 +1055,36 @@ def opt_command(update: Update, context: CallbackContext):
         if opt_in:
             message.reply_text(get_message(user_id, "already_opted_in"))
         else:
-            users[user_id]['opt_in'] = True
+            users.set(user_id, 'opt_in', True)
             message.reply_text(get_message(user_id, "opted_in"))
     else:
         if not opt_in:
             message.reply_text(get_message(user_id, "already_opted_out"))
         else:
-            users[user_id]['opt_in'] = False
+            users.set(user_id, 'opt_in', False)
             message.reply_text(get_message(user_id, "opted_out"))
 
 
+@run_async
+def reload_command(update: Update, context: CallbackContext):
+    message = update.message
+
+    # feedback to show bot is processing
+    bot.send_chat_action(message.chat_id, 'typing')
+    if message.from_user.id in config['admins']:
+        try:
+            restart_keys = reload_files()
+        except (OSError, ValueError, KeyError) as e:
+            message.reply_text(get_message(message.chat_id, "reload_failed").format(e))
+            return
+
+        message.reply_text(get_message(message.chat_id, "reloaded"))
+        if restart_keys:
+            message.reply_text(get_message(message.chat_id, "reload_needs_restart").format(', '.join(restart_keys)))
+    else:
+        message.reply_text(get_message(message.chat_id, "no_permission"))
+
+
 def restart_command(update: Update, context: CallbackContext):
     message = update.message
 
@@ -744,19 +1092,46 @@ def restart_command(update: Update, context: CallbackContext):
     bot.send_chat_action(message.chat_id, 'typing')
     if message.from_user.id in config['admins']:
         message.reply_text(get_message(message.chat_id, "restarting"))
-        save_files()
-        logger.info("Bot restarted by {} ({})".format(message.from_user.first_name, message.from_user.id))
-        os.execl(sys.executable, sys.executable, *sys.argv)
+
+        # the updater waits for the dispatcher to finish this update when stopped so it is stopped from another thread
+        Thread(target=restart, args=(update,), name="restart").start()
     else:
         message.reply_text(get_message(message.chat_id, "no_permission"))
 
 
+def restart(update: Update):
+    # stop taking updates before saving the ones that haven't been handled so none arrive after the queue is emptied
+    if webhook_server is not None:
+        event_loop.run(webhook_server.stop())
+    updater.stop()
+    last_update_id = save_pending_updates(updater.update_queue, pending_updates_path(), update.update_id)
+    if webhook_server is None:
+        # confirm everything up to here so telegram doesn't send the saved updates or this restart again
+        bot.get_updates(offset=last_update_id + 1, timeout=0)
+
+    # workers save their own state and pending updates before they exit
+    if worker_pool is not None:
+        worker_pool.stop(config['shutdown_timeout'])
+        users.flush()
+    else:
+        stop_handling()
+    user = update.message.from_user
+    logger.info("Bot restarted by {} ({})".format(user.first_name, user.id))
+    os.execl(sys.executable, sys.executable, *sys.argv)
+
+
 @run_async
 def start_command(update: Update, context: CallbackContext):
     message = update.message
     # feedback to show bot is processing
     bot.send_chat_action(message.chat_id, 'typing')
-    message.reply_markdown(get_message(message.chat_id, "start"))
+
+    start_message = get_message(message.chat_id, "start")
+
+    # users restart the bot after unblocking it so include them in broadcasts again
+    users.set(message.chat_id, 'blocked', False)
+
+    message.reply_markdown(start_message)
 
 
 @run_async
@@ -767,17 +1142,12 @@ def stats_command(update: Update, context: CallbackContext):
     # feedback to show bot is processing
     bot.send_chat_action(user_id, 'typing')
 
-    opted_in = 0
-    opted_out = 0
-    for user in users.values():
-        if user['opt_in']:
-            opted_in += 1
-        else:
-            opted_out += 1
+    opted_in, opted_out = users.opt_in_counts()
 
     personal_uses = get_user_config(user_id, "uses")
-    stats_message = get_message(user_id, "stats").format(config['uses'], len(users), personal_uses,
-                                                         config['langs_auto_set'], config['times_shared'],
+    stats_message = get_message(user_id, "stats").format(counters.value('uses'), len(users), personal_uses,
+                                                         counters.value('langs_auto_set'),
+                                                         counters.value('times_shared'),
                                                          opted_in + opted_out, opted_in, opted_out)
     message.reply_markdown(stats_message)
 
@@ -789,45 +1159,27 @@ def stats_command(update: Update, context: CallbackContext):
 # |____/  | .__/   \__,_| |_| |_| |_|   |_|     |_| |_|  \__|  \___| |_|
 #         |_|
 
-def record_use(user_id, context: CallbackContext):
-    # ensure user_id is string
-    user_id = str(user_id)
-
-    # ensure user_id has list in recent_uses
-    global recent_uses
-    if user_id not in recent_uses:
-        recent_uses[user_id] = []
+def record_use(user_id):
+    rate_limiter.record(str(user_id))
 
-    job = context.job_queue.run_once(remove_use, config['spam_interval'], context=(user_id, datetime.now()))
-    recent_uses[user_id].append(job)
 
+def count_use(user_id):
+    # record use in spam filter
+    record_use(user_id)
 
-def remove_use(context: CallbackContext):
-    job = context.job
-    user_id = job.context[0]
-    global recent_uses
-    recent_uses[user_id].remove(job)
+    # increase total uses count by one
+    counters.add('uses')
+    return users.increment(user_id, 'uses')
 
 
 def user_on_cooldown(user_id):
-    # ensure user_id is string
-    user_id = str(user_id)
-
-    recent_uses_count = len(recent_uses[user_id]) if user_id in recent_uses else 0
-    on_cooldown = recent_uses_count >= config['spam_max']
-
-    if on_cooldown:
-        oldest_job_time = recent_uses[user_id][0].context[1]
-        seconds_left = int(config['spam_interval'] - (datetime.now() - oldest_job_time).total_seconds())
-        time_left = divmod(seconds_left, 60)
-    else:
-        time_left = 0, 0
-
-    # check to make sure on_cooldown is true while time_left evaluated to 0, 0
-    if time_left[0] == 0 and time_left[1] == 0:
-        on_cooldown = False
+    seconds_left = int(rate_limiter.cooldown(str(user_id)))
+    minutes, seconds = divmod(seconds_left, 60)
 
-    return on_cooldown, time_left[0], time_left[1]
+    # user is not on cooldown once less than a second is left
+    if seconds_left > 0:
+        spam_rejections.inc()
+    return seconds_left > 0, minutes, seconds
 
 
 #  _   _   _     _   _
@@ -836,82 +1188,63 @@ def user_on_cooldown(user_id):
 # | |_| | | |_  | | | | \__ \
 #  \___/   \__| |_| |_| |___/
 
-@run_async
-def broadcast_thread(context: CallbackContext):
-    # check that message was included with the job obj
-    if context.job.context is None:
-        print("Broadcast thread created without message stored in job context")
-        return
-
-    global config
-    index = 0
-    for user_id in list(users):
-        # check if user is opted in
-        opt_in = get_user_config(user_id, "opt_in")
-
-        # catch any errors thrown by users who have stopped bot
-        try:
-            if opt_in and not config['override_opt_out']:
-                bot.send_message(chat_id=int(user_id), text=context.job.context, parse_mode='HTML',
-                                 disable_web_page_preview=True)
-                # send opt out message
-                if config['send_opt_out_message']:
-                    bot.send_message(chat_id=int(user_id), text=get_message(user_id, "opt_out_info"))
-        except Unauthorized:
-            pass
-        except TelegramError as e:
-            # ignore errors from bot trying to message user who has not messaged them first
-            if e.message != 'Chat not found':
-                logger.warning("Error '{}' when broadcasting message to {}".format(e.message, user_id))
-
-        index += 1
-        if index >= config['broadcast_batch_size']:
-            time.sleep(config['broadcast_batch_interval'])
-            index = 0
-
-
-def donate_suggest(user_id):
-    user_uses = users[str(user_id)]['uses']
+async def donate_suggest(user_id, user_uses, messages):
     if user_uses % config['donate_suggest_interval'] == 0:
-        bot.send_message(user_id, get_message(user_id, "donate_suggest").format(user_uses), parse_mode='Markdown')
+        await async_bot.send_message(user_id, messages["donate_suggest"].format(user_uses), parse_mode='Markdown')
 
 
 def get_message(user_id, message):
-    lang_pref = get_user_config(user_id, "lang")
+    return user_messages(user_id)[message]
 
-    # if message doesn't have translation in user's language default to english
-    if message not in lang[lang_pref]:
-        lang_pref = 'en'
 
-    return lang[lang_pref][message]
+def user_messages(user_id):
+    # compiled messages already fall back to english for anything without a translation
+    return catalog.messages[get_user_config(user_id, "lang")]
 
 
 def get_user_config(user_id, key):
-    global users
     user_id = str(user_id)
 
-    # if user not registered register with default values
+    # users are registered from their updates so this only happens for users who have never sent one
     if user_id not in users:
-        users[user_id] = config['default_user'].copy()
-
-        # attempt to automatically set language
-        lang_code = bot.get_chat(user_id).get_member(user_id).user.language_code.lower()
-        if lang_code is not None:
-            for code in lang.keys():
-                if lang_code.startswith(code):
-                    users[user_id]['lang'] = code
-                    if code != 'en':
-                        config['langs_auto_set'] += 1
-    # if user is registered but does not have requested key set to default value from config
-    elif key not in users[user_id]:
-        try:
-            users[user_id][key] = config['default_user'][key].copy()
-        # if value isn't a type with a copy function like a string or int
-        except AttributeError:
-            users[user_id][key] = config['default_user'][key]
+        register_user(user_id, None)
 
     # return value
-    return users[user_id][key]
+    return users.get(user_id, key)
+
+
+def register_update_user(update: Update, context: CallbackContext):
+    user = update.effective_user
+    chat = update.effective_chat
+    # users in groups the bot was added to haven't started it so aren't registered
+    if user is None or (chat is not None and chat.type != 'private'):
+        return
+    if str(user.id) not in users:
+        register_user(str(user.id), user.language_code)
+
+
+def register_user(user_id, lang_code):
+    # if user not registered register with default values
+    user = config['default_user'].copy()
+
+    # attempt to automatically set language from the one their telegram app is in
+    if lang_code is not None:
+        for code in catalog.messages:
+            if lang_code.lower().startswith(code):
+                user['lang'] = code
+
+    # another thread may have registered the user in the meantime
+    if users.register(user_id, user) and user['lang'] != 'en':
+        counters.add('langs_auto_set')
+
+
+@lru_cache(maxsize=128)
+def user_mention(user_id):
+    # names of translators credited in lang.json are looked up once instead of on every language change,
+    # errors aren't cached so failed lookups are tried again next time
+    user = bot.get_chat(user_id)
+    return '<a href="tg://user?id={}">{}{}</a>'.format(user_id, user.first_name,
+                                                       ' ' + user.last_name if user.last_name else '')
 
 
 # logs bot errors thrown
@@ -936,43 +1269,199 @@ def load_json(file_name):
     return data
 
 
+def broadcast_state_path():
+    return os.path.join(directory, 'broadcast.json')
+
+
+def pending_updates_path():
+    return os.path.join(directory, worker_file_name('pending_updates.json'))
+
+
+def pending_updates_paths():
+    # updates saved by this process and by every worker in case the number of workers changed
+    return sorted(glob.glob(os.path.join(directory, 'pending_updates*.json')))
+
+
+def worker_file_name(file_name):
+    # each worker keeps its own copy of files that aren't shared
+    if worker_index is None:
+        return file_name
+    name, extension = os.path.splitext(file_name)
+    return '{}-{}{}'.format(name, worker_index, extension)
+
+
 def save_json(json_obj, file_name):
-    data = json.dumps(json_obj)
     file_path = os.path.join(directory, file_name if file_name.endswith('.json') else file_name + '.json')
-    with open(file_path, "w") as json_file:
-        json_file.write(simplejson.dumps(simplejson.loads(data), indent=4, sort_keys=True))
-    json_file.close()
+    write_atomic(file_path, json.dumps(json_obj, indent=4, sort_keys=True))
 
 
 def load_files():
+    global file_handler
+    if file_handler is None:
+        file_handler = logging.FileHandler(os.path.join(directory, "ez-sticker-bot.log"))
+        file_handler.setFormatter(log_formatter)
+        logger.addHandler(file_handler)
+
     try:
-        global config
-        config = load_json('config.json')
+        config_json = load_json('config.json')
     except FileNotFoundError:
         sys.exit("config.json is missing; exiting")
+    if worker_index is None:
+        initial_counters = migrate_counters(config_json)
+    else:
+        # the process routing updates migrated counters into the shared state before it started the workers
+        initial_counters = {name: 0 for name in COUNTER_NAMES}
+
+    # config is only ever replaced as a whole by a reload, never changed in place
+    global config
+    config = MappingProxyType(dict(DEFAULT_CONFIG, **config_json))
+    logger.setLevel(config['log_level'])
+    global counters, rate_limiter, shared_state
+    if config['shared_state'] == 'sqlite':
+        shared_state = open_sqlite_state(os.path.join(directory, 'state.db'), initial_counters, config['spam_max'],
+                                         config['spam_interval'])
+    elif config['shared_state'] == 'redis':
+        shared_state = open_redis_state(config['redis_url'], initial_counters, config['spam_max'],
+                                        config['spam_interval'])
+
+    if shared_state is not None:
+        counters = shared_state.counters
+        rate_limiter = shared_state.rate_limiter
+    else:
+        counters = FileCounters(os.path.join(directory, 'counters.json'), initial_counters)
+
+        rate_limiter = RateLimiter(config['spam_max'], config['spam_interval'])
+        try:
+            rate_limiter.load(load_json('spam.json'))
+        except FileNotFoundError:
+            pass
+
+    global file_watcher
+    file_watcher = FileWatcher([os.path.join(directory, 'config.json'), os.path.join(directory, 'lang.json')])
+
     try:
-        global lang
-        lang = load_lang()
+        global catalog
+        catalog = Catalog(load_lang(), config)
     except FileNotFoundError:
         sys.exit("lang.json is missing; exiting")
+    global users
+    users_path = os.path.join(directory, 'users.json')
+    journal_path = os.path.join(directory, 'users.journal')
+    if config['user_store'] == 'json':
+        users = JournalUserStore(users_path, journal_path, config['default_user'], config['journal_compact_after'])
+    else:
+        users = SqliteUserStore(os.path.join(directory, 'users.db'), config['default_user'],
+                                config['user_cache_size'])
+
+        # move users from users.json into the database the first time it is used
+        if os.path.exists(users_path):
+            users.migrate(JournalUserStore(users_path, journal_path, config['default_user'], 0).records())
+            os.replace(users_path, users_path + '.migrated')
+            if os.path.exists(journal_path):
+                os.replace(journal_path, journal_path + '.migrated')
+            logger.info("Migrated users.json to users.db")
+
+    global sessions
+    sessions = SessionStore(users, config['session_ttl'])
+
+    global conversion_cache
+    conversion_cache = ConversionCache(config['conversion_cache_size'], config['conversion_cache_ttl'])
     try:
-        global users
-        users = load_json('users.json')
+        conversion_cache.load(load_json(worker_file_name('cache.json')))
     except FileNotFoundError:
-        # if users.json is missing create an empty file and continue
-        save_json({}, 'users.json')
+        pass
+
+
+def migrate_counters(config_json):
+    # counters used to be kept in config.json so they are moved out of it the first time the bot starts
+    try:
+        values = load_json('counters.json')
+    except FileNotFoundError:
+        values = {name: config_json.get(name, 0) for name in COUNTER_NAMES}
+        # a shared state keeps its own counters and only starts from these values
+        if config_json.get('shared_state', DEFAULT_CONFIG['shared_state']) == 'local':
+            save_json(values, 'counters.json')
+
+    if any(name in config_json for name in COUNTER_NAMES):
+        for name in COUNTER_NAMES:
+            config_json.pop(name, None)
+        save_json(config_json, 'config.json')
+        logger.info("Moved counters out of config.json")
+    return {name: values.get(name, 0) for name in COUNTER_NAMES}
+
+
+def reload_files():
+    # /reload, the job reloading edited files and saving can run at once so only one of them runs at a time
+    with reload_lock:
+        return swap_files()
+
+
+def swap_files():
+    global config, catalog
+
+    # read and check both files before swapping anything in so a bad edit leaves the bot running as it was
+    new_config = MappingProxyType(dict(DEFAULT_CONFIG, **load_json('config.json')))
+    errors = validate_config(config, new_config)
+    if errors:
+        raise ValueError(', '.join(errors))
+    new_catalog = Catalog(load_lang(), new_config)
+    restart_keys = [key for key in RESTART_KEYS if new_config[key] != config[key]]
+
+    # apply settings read once when the objects using them were created
+    logger.setLevel(new_config['log_level'])
+    rate_limiter.configure(new_config['spam_max'], new_config['spam_interval'])
+    sessions.ttl = new_config['session_ttl']
+    conversion_cache.max_size = new_config['conversion_cache_size']
+    conversion_cache.ttl = new_config['conversion_cache_ttl']
+    if conversion_engine is not None:
+        conversion_engine.max_queue = new_config['conversion_max_queue']
+        conversion_engine.timeout = new_config['conversion_timeout']
+        conversion_engine.encoder = new_config['png_encoder']
+    if fetcher is not None:
+        fetcher.max_size = new_config['max_file_size']
+
+    # handlers look both up each time they are used so replacing them swaps them in at once
+    config = new_config
+    catalog = new_catalog
+    user_mention.cache_clear()
+    file_watcher.update()
+
+    logger.info("Reloaded config.json and lang.json")
+    if restart_keys:
+        logger.warning("Changes to {} need a restart".format(', '.join(restart_keys)))
+    return restart_keys
+
+
+def reload_changed_files(context: CallbackContext = None):
+    with reload_lock:
+        if not file_watcher.changed():
+            return
+        try:
+            swap_files()
+        except (OSError, ValueError, KeyError) as e:
+            # only try again once the files are edited again
+            file_watcher.update()
+            logger.warning("Could not reload edited files: {}".format(e))
 
 
 def save_files(context: CallbackContext = None):
-    save_json(config, 'config.json')
-    save_json(users, 'users.json')
+    with reload_lock, save_seconds.time():
+        if shared_state is None:
+            counters.flush()
+            save_json(rate_limiter.dump(), 'spam.json')
+        else:
+            shared_state.flush()
+
+        sessions.flush()
+        users.flush()
+        # other workers change users too so count them again from the database
+        if worker_index is not None:
+            users.recount()
+        save_json(conversion_cache.dump(), worker_file_name('cache.json'))
 
 
-def temp_dir():
-    temp_path = os.path.join(directory, 'temp')
-    if not os.path.exists(temp_path):
-        os.mkdir(temp_path)
-    return temp_path
+def flush_users(context: CallbackContext = None):
+    users.flush()
 
 
 if __name__ == '__main__':
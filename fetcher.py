@@ -0,0 +1,117 @@
+import asyncio
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+
+# bytes read at a time while downloading
+CHUNK_SIZE = 64 * 1024
+
+# leading bytes of the image formats users send, checked before downloading the rest of the file
+SIGNATURES = (
+    b'\x89PNG\r\n\x1a\n',  # png
+    b'\xff\xd8\xff',  # jpeg
+    b'GIF87a', b'GIF89a',  # gif
+    b'BM',  # bmp
+    b'II*\x00', b'MM\x00*',  # tiff
+    b'\x00\x00\x01\x00',  # ico
+)
+SNIFF_BYTES = 12
+
+
+# reason is the lang.json message telling the user why their url couldn't be used
+class FetchError(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+# downloads images from urls over pooled connections without ever holding more than max_size bytes of a response
+class Fetcher:
+    def __init__(self, max_size, timeout, max_per_host, failure_ttl, pool_size):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.failure_ttl = failure_ttl
+        self.pool_size = pool_size
+        self._failures = {}
+        self._last_sweep = time.monotonic()
+        self._session = None
+
+    async def fetch(self, url):
+        try:
+            parsed = urlparse(url)
+            host = parsed.hostname
+            port = parsed.port
+        except ValueError:
+            raise FetchError('invalid_url')
+        if not host or parsed.scheme not in ('http', 'https'):
+            raise FetchError('invalid_url')
+
+        # don't wait on servers that just failed to connect, other ports of the same host can still work
+        server = (parsed.scheme, host, port or (443 if parsed.scheme == 'https' else 80))
+        if self._failures.get(server, 0) > time.monotonic():
+            raise FetchError('unable_to_connect')
+
+        try:
+            return await self._download(url)
+        except asyncio.TimeoutError:
+            self._record_failure(server)
+            raise FetchError('url_timeout')
+        except aiohttp.InvalidURL:
+            raise FetchError('invalid_url')
+        except aiohttp.ClientResponseError:
+            raise FetchError('url_does_not_exist')
+        except (aiohttp.ClientError, UnicodeError, ValueError):
+            self._record_failure(server)
+            raise FetchError('unable_to_connect')
+
+    async def _download(self, url):
+        # the timeout covers the whole download so a server sending slowly can't hold it open forever
+        async with self.session().get(url, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+            response.raise_for_status()
+
+            # trust a size the server reports but keep counting in case it lied or left it out
+            if response.content_length is not None and response.content_length > self.max_size:
+                raise FetchError('file_too_large')
+
+            content = bytearray()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                content += chunk
+                if len(content) > self.max_size:
+                    raise FetchError('file_too_large')
+                # stop as soon as the start of the file shows it isn't an image
+                if len(content) - len(chunk) < SNIFF_BYTES <= len(content) and not is_image(content):
+                    raise FetchError('url_not_img')
+
+        if not is_image(content):
+            raise FetchError('url_not_img')
+        return bytes(content)
+
+    def session(self):
+        # connections are kept open between requests so repeat hosts skip the tcp and tls handshakes and
+        # downloads from one host are limited so a single slow server can't take every connection
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.max_per_host)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    def _record_failure(self, server):
+        now = time.monotonic()
+        self._failures[server] = now + self.failure_ttl
+
+        # forget expired failures every so often so the cache doesn't grow without bound
+        if now - self._last_sweep >= self.failure_ttl:
+            self._failures = {server: until for server, until in self._failures.items() if until > now}
+            self._last_sweep = now
+
+
+def is_image(data):
+    # webp is a riff container so its signature is split around the file size
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return True
+    return data.startswith(SIGNATURES)
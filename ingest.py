@@ -0,0 +1,86 @@
+import hmac
+import json
+import logging
+import os
+from queue import Empty
+
+from aiohttp import web
+from telegram import Update
+
+from storage import write_atomic
+
+logger = logging.getLogger()
+
+# header telegram sends the secret token given to setWebhook in
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+# http listener on the event loop that hands updates telegram posts to the dispatcher
+class WebhookServer:
+    def __init__(self, bot, update_queue, listen, port, path, secret_token):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.listen = listen
+        self.port = port
+        self.path = path or '/'
+        self.secret_token = secret_token
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+
+    async def stop(self):
+        # telegram keeps updates it can't deliver and sends them again once the listener is back
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request):
+        # anyone can post to the listener so only accept updates carrying the secret given to telegram
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret_token):
+            return web.Response(status=403)
+
+        try:
+            body = await request.json()
+            # de_json fails on anything that isn't an object and returns None for an empty one
+            update = Update.de_json(body, self.bot) if isinstance(body, dict) else None
+        except (ValueError, KeyError, TypeError):
+            update = None
+        if update is None:
+            return web.Response(status=400)
+
+        # answer straight away so telegram can send the next update over the connection
+        self.update_queue.put(update)
+        return web.Response()
+
+
+def save_pending_updates(update_queue, path, last_update_id):
+    # take every update that arrived but hasn't been handled yet off the queue and save it for the next start
+    updates = []
+    while True:
+        try:
+            update = update_queue.get_nowait()
+        except Empty:
+            break
+        if isinstance(update, Update):
+            updates.append(update.to_dict())
+            last_update_id = max(last_update_id, update.update_id)
+
+    if updates:
+        write_atomic(path, json.dumps(updates))
+        logger.info("Saved {} pending updates".format(len(updates)))
+    return last_update_id
+
+
+def load_pending_updates(path, bot):
+    try:
+        with open(path) as updates_file:
+            updates = json.load(updates_file)
+    except FileNotFoundError:
+        return []
+    os.remove(path)
+    return [Update.de_json(update, bot) for update in updates]
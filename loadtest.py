@@ -0,0 +1,369 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shutil
+import signal
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+import ezstickerbot
+from asyncbot import EventLoop
+from benchmark import make_photo, make_transparent, percentile, save
+
+# ids of synthetic users start here so they can't be mistaken for real ones
+FIRST_USER_ID = 900000000
+
+# kinds of requests users send and how often they send each
+KINDS = ('photo', 'sticker', 'url', 'inline')
+WEIGHTS = (0.5, 0.25, 0.15, 0.1)
+
+# methods that can be made to fail, receiving updates always works so the bot keeps running
+FAILING_METHODS = ('getFile', 'sendChatAction', 'sendDocument', 'editMessageReplyMarkup', 'answerInlineQuery',
+                   'sendMessage')
+
+# replies that finish a request, anything the bot sends before them is progress
+FINAL_METHODS = ('editMessageReplyMarkup', 'sendMessage', 'answerInlineQuery')
+
+# settings the bot is run with on top of config_example.json
+CONFIG = {
+    'token': '123456:LOADTEST',
+    'log_level': 'WARNING',
+    'spam_max': 1000000,
+    'donate_suggest_interval': 1000000,
+    'metrics_port': 0,
+    'profile_threshold': 0,
+    'update_mode': 'polling',
+    'worker_processes': 1,
+    'shared_state': 'local',
+    'telegram_timeout': 5,
+}
+
+
+# stand in for telegram's bot api that answers every method the bot uses and can be slowed down or made to fail
+class FakeBotApi:
+    def __init__(self, latency, retry_after_rate, timeout_rate, unauthorized_rate, timeout_delay):
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.timeout_rate = timeout_rate
+        self.unauthorized_rate = unauthorized_rate
+        self.timeout_delay = timeout_delay
+        self.files = {}
+        self.images = {}
+        self.calls = Counter()
+        self.injected = Counter()
+        self.on_reply = None
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_updates = None
+        self._runner = None
+
+    async def start(self, host, port):
+        self._new_updates = asyncio.Event()
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_get('/bot{token}/{method}', self.handle)
+        app.router.add_get('/file/bot{token}/{path:.*}', self.download)
+        app.router.add_get('/images/{name}', self.image)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def add_update(self, update):
+        update['update_id'] = next(self._update_ids)
+        self._updates.append(update)
+        self._new_updates.set()
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = await read_params(request)
+        self.calls[method] += 1
+
+        if method == 'getUpdates':
+            return ok(await self.get_updates(params))
+
+        if method in FAILING_METHODS:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+            error = self.inject_error(method)
+            if error is not None:
+                if self.on_reply is not None:
+                    self.on_reply(method, params, error)
+                if error == 'timed_out':
+                    # answer after the bot has given up waiting, the bot never sees it so it doesn't finish the request
+                    await asyncio.sleep(self.timeout_delay)
+                    return ok(True)
+                elif error == 'retry_after':
+                    return web.json_response({'ok': False, 'error_code': 429, 'parameters': {'retry_after': 1},
+                                              'description': "Too Many Requests: retry after 1"}, status=429)
+                else:
+                    return web.json_response({'ok': False, 'error_code': 403,
+                                              'description': "Forbidden: bot was blocked by the user"}, status=403)
+
+        if method == 'getFile' and params.get('file_id') not in self.files:
+            return web.json_response({'ok': False, 'error_code': 400, 'description': "Bad Request: invalid file_id"},
+                                     status=400)
+
+        result = self.result(method, params)
+        if self.on_reply is not None and method in FINAL_METHODS:
+            self.on_reply(method, params, None)
+        return ok(result)
+
+    def inject_error(self, method):
+        roll = random.random()
+        for error, rate in (('retry_after', self.retry_after_rate), ('timed_out', self.timeout_rate),
+                            ('unauthorized', self.unauthorized_rate)):
+            if roll < rate:
+                self.injected[error, method] += 1
+                return error
+            roll -= rate
+        return None
+
+    async def get_updates(self, params):
+        # updates before the offset were handled so telegram forgets them
+        offset = int(params.get('offset') or 0)
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates:
+            # long poll but return regularly so the bot notices when it is stopped
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), min(float(params.get('timeout') or 0), 1))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get('limit') or 100)]
+
+    def result(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': "EzStickerBot", 'username': "EzStickerBot"}
+        if method == 'getMyCommands':
+            return []
+        if method == 'getFile':
+            file_id = params['file_id']
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(self.files[file_id]),
+                    'file_path': 'documents/' + file_id}
+        if method in ('sendMessage', 'sendDocument', 'editMessageReplyMarkup'):
+            message = {'message_id': next(self._message_ids), 'date': int(time.time()),
+                       'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}}
+            if method == 'sendDocument':
+                file_id = 'document-{}'.format(message['message_id'])
+                message['document'] = {'file_id': file_id, 'file_unique_id': file_id}
+            return message
+        return True
+
+    async def download(self, request):
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        file_id = request.match_info['path'].split('/')[-1]
+        if file_id not in self.files:
+            return web.Response(status=404)
+        return web.Response(body=self.files[file_id])
+
+    async def image(self, request):
+        name = request.match_info['name']
+        if name not in self.images:
+            return web.Response(status=404)
+        return web.Response(body=self.images[name], content_type='image/png')
+
+
+# synthetic users that each send a request, wait for the bot to finish it and think before sending the next
+class LoadGenerator:
+    def __init__(self, api, base_url, users, requests, think_time, ramp, deadline):
+        self.api = api
+        self.base_url = base_url
+        self.users = users
+        self.requests = requests
+        self.think_time = think_time
+        self.ramp = ramp
+        self.deadline = deadline
+        self.latencies = defaultdict(list)
+        self.sent = Counter()
+        self.errors = Counter()
+        self.lost = Counter()
+        self.replies = Counter()
+        self._waiting = {}
+        self._ids = itertools.count(1)
+        self._corpus = make_load_corpus()
+        api.on_reply = self.reply
+
+        # images from urls are the same for everyone like popular images going around
+        for name, data in self._corpus.items():
+            api.images[name] = data
+
+    async def run(self):
+        start = time.perf_counter()
+        await asyncio.gather(*(self.user(index) for index in range(self.users)))
+        return time.perf_counter() - start
+
+    async def user(self, index):
+        await asyncio.sleep(self.ramp * index / self.users)
+        user = {'id': FIRST_USER_ID + index, 'is_bot': False, 'first_name': "User {}".format(index),
+                'language_code': random.choice(('en', 'en', 'es', 'de', 'pt', 'ru'))}
+        for _ in range(self.requests):
+            kind = random.choices(KINDS, WEIGHTS)[0]
+            key, update = self.make_update(kind, user)
+            future = asyncio.get_running_loop().create_future()
+            self._waiting[key] = (future, kind)
+            self.sent[kind] += 1
+            start = time.perf_counter()
+            self.api.add_update(update)
+            try:
+                await asyncio.wait_for(future, self.deadline)
+                self.latencies[kind].append((time.perf_counter() - start) * 1000)
+            except asyncio.TimeoutError:
+                self._waiting.pop(key, None)
+                self.lost[kind] += 1
+            await asyncio.sleep(random.expovariate(1 / self.think_time) if self.think_time else 0)
+
+    def make_update(self, kind, user):
+        chat = {'id': user['id'], 'type': 'private', 'first_name': user['first_name']}
+        message = {'message_id': next(self._ids), 'date': int(time.time()), 'chat': chat, 'from': user}
+        if kind == 'inline':
+            query_id = str(next(self._ids))
+            return query_id, {'inline_query': {'id': query_id, 'from': user, 'query': 'share', 'offset': ''}}
+
+        name, data = random.choice(list(self._corpus.items()))
+        if kind == 'url':
+            message['text'] = '{}/images/{}'.format(self.base_url, name)
+            return user['id'], {'message': message}
+
+        # every file sent is new to the bot so its conversion can't come from the cache
+        file_id = '{}-{}'.format(kind, next(self._ids))
+        self.api.files[file_id] = data
+        file = {'file_id': file_id, 'file_unique_id': file_id, 'width': 512, 'height': 512, 'file_size': len(data)}
+        if kind == 'sticker':
+            message['sticker'] = dict(file, is_animated=False)
+        else:
+            message['photo'] = [file]
+        return user['id'], {'message': message}
+
+    def reply(self, method, params, error):
+        key = params.get('inline_query_id') if method == 'answerInlineQuery' else params.get('chat_id')
+        if key is None:
+            return
+        key = key if method == 'answerInlineQuery' else int(key)
+        if key not in self._waiting:
+            return
+
+        # requests that hit an injected error finish with whatever the bot replies next
+        future, kind = self._waiting[key]
+        if error is not None:
+            self.errors[kind] += 1
+            return
+        del self._waiting[key]
+        # a message instead of a sticker is the bot saying it is busy or the input was bad
+        self.replies[kind, method] += 1
+        if not future.done():
+            future.set_result(None)
+
+    def report(self, duration):
+        print("{:>8} {:>7} {:>7} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+            "kind", "sent", "done", "errors", "lost", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+        for kind in KINDS + ('total',):
+            if kind == 'total':
+                latencies = list(itertools.chain.from_iterable(self.latencies.values()))
+                sent, errors, lost = sum(self.sent.values()), sum(self.errors.values()), sum(self.lost.values())
+            else:
+                latencies = self.latencies[kind]
+                sent, errors, lost = self.sent[kind], self.errors[kind], self.lost[kind]
+            if not latencies:
+                latencies = [0]
+            print("{:>8} {:>7} {:>7} {:>7} {:>7} {:>9.0f} {:>9.0f} {:>9.0f} {:>9.0f}".format(
+                kind, sent, len(self.latencies[kind]) if kind != 'total' else sum(map(len, self.latencies.values())),
+                errors, lost, percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99),
+                max(latencies)))
+
+        done = sum(map(len, self.latencies.values()))
+        print("{} requests finished in {:.1f}s, {:.1f} requests/s".format(done, duration, done / duration))
+        print("final replies: " + ', '.join('{} {} {}'.format(kind, method, count) for (kind, method), count in
+                                            sorted(self.replies.items())))
+        print("api calls: " + ', '.join('{} {}'.format(method, count) for method, count in
+                                        sorted(self.api.calls.items())))
+        if self.api.injected:
+            print("injected errors: " + ', '.join('{} {} {}'.format(error, method, count) for (error, method), count
+                                                  in sorted(self.api.injected.items())))
+
+
+def make_load_corpus():
+    # small set of typical inputs, the benchmark covers the unusual ones
+    corpus = {'photo.jpg': save(make_photo(1280, 960, seed=1280), 'JPEG', quality=85)}
+    corpus['transparent.png'] = save(make_transparent(800, 800), 'PNG')
+    corpus['sticker.webp'] = save(make_transparent(512, 512), 'WEBP', quality=80)
+    return corpus
+
+
+async def read_params(request):
+    if request.content_type.startswith('multipart'):
+        form = await request.post()
+        return {key: value.file.read() if hasattr(value, 'file') else value for key, value in form.items()}
+    if request.content_type == 'application/json' and request.can_read_body:
+        return await request.json()
+    return dict(await request.post()) if request.can_read_body else dict(request.query)
+
+
+def ok(result):
+    return web.json_response({'ok': True, 'result': result})
+
+
+def make_directory(directory, base_url):
+    # the bot runs from its own directory so its users and counters don't mix with a real bot's
+    source = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(source, 'config_example.json')) as file:
+        config = json.load(file)
+    config.update(CONFIG, telegram_base_url=base_url + '/bot', telegram_base_file_url=base_url + '/file/bot')
+    with open(os.path.join(directory, 'config.json'), 'w') as file:
+        json.dump(config, file, indent=4, sort_keys=True)
+    shutil.copy(os.path.join(source, 'lang.json'), directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot against a fake bot api with synthetic users")
+    parser.add_argument('-u', '--users', type=int, default=1000, help="synthetic users")
+    parser.add_argument('-n', '--requests', type=int, default=3, help="requests sent by each user")
+    parser.add_argument('--think-time', type=float, default=2.0, help="mean seconds users wait between requests")
+    parser.add_argument('--ramp', type=float, default=10.0, help="seconds over which users start")
+    parser.add_argument('--deadline', type=float, default=60.0, help="seconds before a request counts as lost")
+    parser.add_argument('--latency', type=float, default=0.05, help="mean seconds added to every api call")
+    parser.add_argument('--retry-after', type=float, default=0.0, help="fraction of calls answered with flood control")
+    parser.add_argument('--timed-out', type=float, default=0.0, help="fraction of calls answered too late")
+    parser.add_argument('--unauthorized', type=float, default=0.0, help="fraction of calls answered with blocked")
+    parser.add_argument('--port', type=int, default=8082, help="port of the fake bot api")
+    parser.add_argument('--directory', help="directory the bot keeps its files in, a temporary one by default")
+    args = parser.parse_args()
+
+    base_url = 'http://127.0.0.1:{}'.format(args.port)
+    directory = args.directory or tempfile.mkdtemp(prefix='ezstickerbot-loadtest-')
+    make_directory(directory, base_url)
+    ezstickerbot.directory = directory
+
+    api = FakeBotApi(args.latency, args.retry_after, args.timed_out, args.unauthorized, CONFIG['telegram_timeout'] + 1)
+    loop = EventLoop()
+    loop.start()
+    loop.run(api.start('127.0.0.1', args.port))
+
+    async def run_load():
+        generator = LoadGenerator(api, base_url, args.users, args.requests, args.think_time, args.ramp, args.deadline)
+        # give the bot a moment to start polling
+        await asyncio.sleep(1)
+        duration = await generator.run()
+        generator.report(duration)
+
+        # stop the bot the same way ctrl+c does
+        os.kill(os.getpid(), signal.SIGINT)
+
+    loop.submit(run_load())
+    ezstickerbot.main()
+    loop.run(api.stop())
+    print("bot files are in {}".format(directory))
+
+
+if __name__ == '__main__':
+    main()
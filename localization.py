@@ -0,0 +1,95 @@
+import logging
+import string
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+
+logger = logging.getLogger()
+
+formatter = string.Formatter()
+
+
+# lang.json compiled into complete message tables and prebuilt markups for every language
+class Catalog:
+    def __init__(self, data, config):
+        english = data['en']
+        self.messages = {}
+        for code, messages in data.items():
+            self.messages[code] = compile_messages(code, messages, english)
+
+        # language picker is the same for everyone so it is only built once
+        ordered_codes = sorted(self.messages, key=lambda code: int(self.messages[code]['order']))
+        keyboard = [[]]
+        for code in ordered_codes:
+            if len(keyboard[-1]) == 3:
+                keyboard.append([])
+            keyboard[-1].append(
+                InlineKeyboardButton(self.messages[code]['lang_name'], callback_data="lang:{}".format(code)))
+        self.lang_keyboard = InlineKeyboardMarkup(keyboard)
+
+        self.info_keyboards = {}
+        self.icon_keyboards = {}
+        self.share_results = {}
+        for code, messages in self.messages.items():
+            self.info_keyboards[code] = InlineKeyboardMarkup([
+                [InlineKeyboardButton(messages["contact_dev"], url=config['contact_dev_link']),
+                 InlineKeyboardButton(messages["source"], url=config['source_link'])],
+                [InlineKeyboardButton(messages["rate"], url=config['rate_link']),
+                 InlineKeyboardButton(messages["share"], switch_inline_query="share")]])
+
+            self.icon_keyboards[code] = InlineKeyboardMarkup(
+                [[InlineKeyboardButton(messages["cancel"], callback_data="icon_cancel")]])
+
+            markup = InlineKeyboardMarkup(
+                [[InlineKeyboardButton(text=messages["make_sticker_button"], url="https://t.me/EzStickerBot")]])
+            input_message_content = InputTextMessageContent(messages["share_text"], parse_mode='Markdown')
+            self.share_results[code] = [
+                InlineQueryResultArticle(id="share", title=messages["share"], description=messages["share_desc"],
+                                         thumb_url=config['share_thumb_url'], reply_markup=markup,
+                                         input_message_content=input_message_content)]
+
+
+def compile_messages(code, messages, english):
+    compiled = dict(english)
+
+    missing = [key for key in english if key not in messages]
+    if missing:
+        logger.info("Language '{}' is missing {} and will use English for them".format(code, ', '.join(missing)))
+
+    for key, text in messages.items():
+        if key not in english:
+            logger.warning("Language '{}' has unknown message '{}'".format(code, key))
+            continue
+
+        # translations must use the same format arguments as english or formatting them breaks
+        try:
+            valid = format_fields(text) == format_fields(english[key])
+        except ValueError:
+            valid = False
+        if not valid:
+            logger.warning("Language '{}' has bad placeholders in '{}' and will use English for it".format(code, key))
+            continue
+
+        compiled[key] = text
+
+    return compiled
+
+
+def format_fields(text):
+    # set of arguments a format string uses with automatic numbering resolved to indexes
+    fields = set()
+    auto_index = 0
+    manual = False
+    for _, field_name, _, _ in formatter.parse(text):
+        if field_name is None:
+            continue
+        if field_name == '':
+            field_name = str(auto_index)
+            auto_index += 1
+        else:
+            manual = True
+        fields.add(field_name.split('.')[0].split('[')[0])
+
+    # str.format refuses strings that mix automatic and manual numbering
+    if manual and auto_index:
+        raise ValueError("Cannot mix automatic and manual field numbering")
+    return fields
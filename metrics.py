@@ -0,0 +1,141 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+
+from aiohttp import web
+
+# upper bounds in seconds of the buckets latencies are counted in
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+
+# counts of observed values in buckets along with their sum for each set of label values
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        with self._lock:
+            series = [(label_values, list(counts), total, count)
+                      for label_values, (counts, total, count) in self._series.items()]
+
+        lines = header(self, 'histogram')
+        for label_values, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(sample(self.name + '_bucket', self.labels + ('le',), label_values + (bound,),
+                                    cumulative))
+            lines.append(sample(self.name + '_sum', self.labels, label_values, total))
+            lines.append(sample(self.name + '_count', self.labels, label_values, count))
+        return lines
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return header(self, 'counter') + [sample(self.name, self.labels, label_values, value)
+                                          for label_values, value in sorted(values.items())]
+
+
+# value read from a function only when metrics are scraped so it costs nothing in between
+class Gauge:
+    def __init__(self, name, description, function, label=None):
+        self.name = name
+        self.description = description
+        self.function = function
+        # with a label the function returns a dict of label values to values
+        self.labels = (label,) if label else ()
+
+    def render(self):
+        value = self.function()
+        values = value.items() if self.labels else [((), value)]
+        return header(self, 'gauge') + [sample(self.name, self.labels, label_value if self.labels else (), value)
+                                        for label_value, value in values]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def header(metric, metric_type):
+    return ['# HELP {} {}'.format(metric.name, metric.description), '# TYPE {} {}'.format(metric.name, metric_type)]
+
+
+def sample(name, labels, label_values, value):
+    if not isinstance(label_values, tuple):
+        label_values = (label_values,)
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(label, label_value) for label, label_value in
+                               zip(labels, label_values)) + '}'
+    return '{} {}'.format(name, value)
+
+
+# serves metrics in prometheus' text format from the event loop
+class MetricsServer:
+    def __init__(self, registry, listen, port):
+        self.registry = registry
+        self.listen = listen
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request):
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
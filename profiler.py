@@ -0,0 +1,191 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from functools import wraps
+from threading import Lock, Thread, get_ident
+
+logger = logging.getLogger()
+
+# frames of a sampled stack kept in reports, counted from the innermost one
+STACK_DEPTH = 12
+
+
+# times every update handled by the wrapped handlers and samples the stacks of the ones still running so the slowest
+# updates can be looked at afterwards
+class Profiler:
+    def __init__(self, threshold, top_size, sample_interval):
+        self.threshold = threshold
+        self.top_size = top_size
+        self.sample_interval = sample_interval
+        self._active = {}
+        self._slowest = []
+        self._ids = itertools.count()
+        self._lock = Lock()
+        self._thread = Thread(target=self._sample, name="profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def wrap(self, func):
+        @wraps(func)
+        def profiled(update, context):
+            record = self._begin(func, update, thread=get_ident())
+            try:
+                return func(update, context)
+            finally:
+                self._end(record)
+
+        return profiled
+
+    def wrap_coroutine(self, func):
+        # coroutines share the event loop thread so only their wall time is known and their stacks are sampled from
+        # the task running them
+        @wraps(func)
+        async def profiled(update, context):
+            record = self._begin(func, update, task=asyncio.current_task())
+            try:
+                return await func(update, context)
+            finally:
+                self._end(record)
+
+        return profiled
+
+    def report(self):
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+
+        lines = []
+        for _, _, record in slowest:
+            lines.append("{} {} {} ({}, {}) {:.0f}ms wall {} cpu, {} samples".format(
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['started'])), record['handler'],
+                record['update_id'], record['type'], format_size(record['size']), record['wall'] * 1000,
+                '-' if record['cpu'] is None else '{:.0f}ms'.format(record['cpu'] * 1000),
+                sum(record['samples'].values())))
+            lines.extend(format_samples(record['samples']))
+            lines.append('')
+        return '\n'.join(lines)
+
+    def _begin(self, func, update, thread=None, task=None):
+        update_type, size = describe_update(update)
+        record = {'handler': func.__name__, 'update_id': getattr(update, 'update_id', None), 'type': update_type,
+                  'size': size, 'started': time.time(), 'start': time.perf_counter(), 'thread': thread, 'task': task,
+                  'cpu_start': time.thread_time() if thread is not None else None, 'samples': Counter(),
+                  'id': next(self._ids)}
+        with self._lock:
+            self._active[record['id']] = record
+        return record
+
+    def _end(self, record):
+        record['wall'] = time.perf_counter() - record['start']
+        record['cpu'] = time.thread_time() - record['cpu_start'] if record['thread'] is not None else None
+        with self._lock:
+            del self._active[record['id']]
+            record['task'] = None
+            if record['wall'] < self.threshold:
+                return
+            # the sampler adds to samples under the lock so they are copied under it too
+            samples = Counter(record['samples'])
+
+            # only the slowest updates are kept
+            entry = (record['wall'], record['id'], record)
+            if len(self._slowest) < self.top_size:
+                heapq.heappush(self._slowest, entry)
+            else:
+                heapq.heappushpop(self._slowest, entry)
+
+        logger.warning("Slow update {} took {:.0f}ms in {} ({}, {})\n{}".format(
+            record['update_id'], record['wall'] * 1000, record['handler'], record['type'], format_size(record['size']),
+            '\n'.join(format_samples(samples))))
+
+    def _sample(self):
+        while True:
+            time.sleep(self.sample_interval)
+            with self._lock:
+                active = list(self._active.values())
+            if not active:
+                continue
+
+            frames = sys._current_frames()
+            for record in active:
+                if record['thread'] is not None:
+                    stack = thread_stack(frames.get(record['thread']))
+                else:
+                    task = record['task']
+                    stack = coroutine_stack(task.get_coro()) if task is not None else []
+                if not stack:
+                    continue
+
+                # an update that finished since it was copied would be given the stack of whatever its thread runs next
+                stack = format_stack(stack)
+                with self._lock:
+                    if record['id'] in self._active:
+                        record['samples'][stack] += 1
+
+
+def describe_update(update):
+    # kind of update and the size of what it carries so slow updates can be told apart by their input
+    message = getattr(update, 'effective_message', None)
+    if getattr(update, 'inline_query', None) is not None:
+        return 'inline_query', len(update.inline_query.query)
+    if getattr(update, 'callback_query', None) is not None:
+        return 'callback_query', len(update.callback_query.data or '')
+    if getattr(update, 'chosen_inline_result', None) is not None:
+        return 'chosen_inline_result', None
+    if message is not None:
+        if message.animation is not None:
+            return 'animation', message.animation.file_size
+        if message.video is not None:
+            return 'video', message.video.file_size
+        if message.document is not None:
+            return 'document', message.document.file_size
+        if message.sticker is not None:
+            return 'animated_sticker' if message.sticker.is_animated else 'sticker', message.sticker.file_size
+        if message.photo:
+            return 'photo', message.photo[-1].file_size
+        if message.text is not None:
+            return 'command' if message.text.startswith('/') else 'text', len(message.text)
+        return 'message', None
+    return 'update', None
+
+
+def thread_stack(frame):
+    stack = []
+    while frame is not None:
+        stack.append(frame)
+        frame = frame.f_back
+    return stack[::-1]
+
+
+def coroutine_stack(coroutine):
+    # follow what each coroutine is awaiting down to the one that is suspended or running
+    stack = []
+    while coroutine is not None:
+        frame = getattr(coroutine, 'cr_frame', None) or getattr(coroutine, 'gi_frame', None)
+        if frame is None:
+            break
+        stack.append(frame)
+        coroutine = getattr(coroutine, 'cr_await', None) or getattr(coroutine, 'gi_yieldfrom', None)
+    return stack
+
+
+def format_stack(stack):
+    return tuple('{}:{} {}'.format(os.path.basename(frame.f_code.co_filename), frame.f_lineno, frame.f_code.co_name)
+                 for frame in stack[-STACK_DEPTH:])
+
+
+def format_samples(samples):
+    # most common stacks first with the innermost frame last
+    lines = []
+    for stack, count in samples.most_common(3):
+        lines.append("  {} samples:".format(count))
+        lines.extend("    " + frame for frame in stack)
+    return lines
+
+
+def format_size(size):
+    return '-' if size is None else '{:,}'.format(size)
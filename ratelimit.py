@@ -0,0 +1,56 @@
+import time
+from collections import deque
+from threading import Lock
+
+
+# sliding window limiter keeping a ring buffer of each user's most recent use times
+class RateLimiter:
+    def __init__(self, max_uses, interval):
+        self.max_uses = max_uses
+        self.interval = interval
+        self._uses = {}
+        self._lock = Lock()
+        self._last_sweep = time.time()
+
+    def __len__(self):
+        return len(self._uses)
+
+    def record(self, user_id):
+        now = time.time()
+        with self._lock:
+            uses = self._uses.get(user_id)
+            if uses is None:
+                uses = self._uses[user_id] = deque(maxlen=self.max_uses)
+            uses.append(now)
+
+            # forget idle users every so often instead of scheduling a job for every use
+            if now - self._last_sweep >= self.interval:
+                self._sweep(now)
+
+    def cooldown(self, user_id):
+        # a user is limited when the oldest of their last max_uses uses is still inside the window
+        with self._lock:
+            uses = self._uses.get(user_id)
+            if uses is None or len(uses) < self.max_uses:
+                return 0
+            return max(0, self.interval - (time.time() - uses[0]))
+
+    def configure(self, max_uses, interval):
+        with self._lock:
+            self.max_uses = max_uses
+            self.interval = interval
+            self._uses = {user_id: deque(uses, maxlen=max_uses) for user_id, uses in self._uses.items()}
+
+    def dump(self):
+        with self._lock:
+            self._sweep(time.time())
+            return {user_id: list(uses) for user_id, uses in self._uses.items()}
+
+    def load(self, uses):
+        with self._lock:
+            self._uses = {user_id: deque(times, maxlen=self.max_uses) for user_id, times in uses.items()}
+            self._sweep(time.time())
+
+    def _sweep(self, now):
+        self._uses = {user_id: uses for user_id, uses in self._uses.items() if now - uses[-1] < self.interval}
+        self._last_sweep = now
@@ -0,0 +1,67 @@
+import os
+
+from conversion import ENCODERS
+
+# settings only read when the bot starts so changing them needs a restart
+RESTART_KEYS = ('token', 'default_user', 'user_store', 'user_cache_size', 'journal_compact_after', 'worker_processes',
+                'shared_state', 'redis_url', 'update_mode', 'webhook_url', 'webhook_listen', 'webhook_port',
+                'webhook_secret', 'webhook_max_connections', 'conversion_workers', 'conversion_recycle_after',
+                'telegram_max_connections', 'telegram_timeout', 'telegram_base_url', 'telegram_base_file_url',
+                'url_timeout', 'url_max_per_host', 'url_failure_ttl', 'url_pool_size', 'save_interval',
+                'reload_interval', 'metrics_listen', 'metrics_port', 'profile_threshold', 'profile_top',
+                'profile_sample_interval', 'ffmpeg_path')
+
+# values of settings added since the first config.json, config.json overrides them so configs written before a setting
+# was added still work without being edited
+DEFAULT_CONFIG = {
+    'save_interval': 300, 'reload_interval': 10, 'shutdown_timeout': 30, 'log_level': 'INFO',
+    'metrics_listen': '127.0.0.1', 'metrics_port': 9464,
+    'profile_threshold': 0, 'profile_top': 20, 'profile_sample_interval': 0.01,
+    'worker_processes': 1, 'shared_state': 'local', 'redis_url': 'redis://localhost:6379/0',
+    'update_mode': 'polling', 'drop_pending_updates': False, 'webhook_url': 'https://example.com/ezstickerbot',
+    'webhook_listen': '127.0.0.1', 'webhook_port': 8443, 'webhook_secret': '', 'webhook_max_connections': 40,
+    'broadcast_rate': 25, 'broadcast_workers': 8, 'broadcast_report_interval': 300,
+    'telegram_max_connections': 100, 'telegram_timeout': 30, 'telegram_base_url': 'https://api.telegram.org/bot',
+    'telegram_base_file_url': 'https://api.telegram.org/file/bot',
+    'url_timeout': 10, 'url_max_per_host': 4, 'url_failure_ttl': 300, 'url_pool_size': 20,
+    'conversion_cache_size': 100000, 'conversion_cache_ttl': 2592000, 'conversion_workers': 2,
+    'conversion_max_queue': 20, 'conversion_timeout': 30, 'conversion_recycle_after': 500, 'png_encoder': 'adaptive',
+    'ffmpeg_path': 'ffmpeg', 'animation_max_pixels': 4194304, 'animation_memory_limit': 512,
+    'user_store': 'sqlite', 'user_cache_size': 100000, 'journal_compact_after': 10000, 'session_ttl': 3600,
+}
+
+
+# notices when files change on disk by comparing their modification times
+class FileWatcher:
+    def __init__(self, paths):
+        self.paths = paths
+        self._mtimes = {}
+        self.update()
+
+    def changed(self):
+        return [path for path in self.paths if modified_time(path) != self._mtimes[path]]
+
+    def update(self):
+        # called after the files were loaded or written by the bot itself
+        self._mtimes = {path: modified_time(path) for path in self.paths}
+
+
+def modified_time(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def validate_config(current, new):
+    # a reloaded config must still have every setting the running one has with a value of the same type
+    errors = []
+    for key, value in current.items():
+        if key not in new:
+            errors.append("'{}' is missing".format(key))
+        elif isinstance(value, bool) != isinstance(new[key], bool) or \
+                not isinstance(new[key], (int, float) if isinstance(value, (int, float)) else type(value)):
+            errors.append("'{}' should be {}".format(key, type(value).__name__))
+    if not errors and new['png_encoder'] not in ENCODERS:
+        errors.append("'png_encoder' should be one of {}".format(', '.join(ENCODERS)))
+    return errors
@@ -0,0 +1,57 @@
+import time
+from threading import Lock
+
+
+# short lived per user flags kept in memory and written behind to the user store so they survive restarts
+class SessionStore:
+    def __init__(self, users, ttl):
+        self.users = users
+        self.ttl = ttl
+        self._sessions = {}
+        self._dirty = set()
+        self._lock = Lock()
+
+    def get(self, user_id, key, default=None):
+        with self._lock:
+            return self._session(int(user_id))['values'].get(key, default)
+
+    def set(self, user_id, key, value):
+        user_id = int(user_id)
+        with self._lock:
+            session = self._session(user_id)
+            session['values'][key] = value
+            # sessions expire a while after they were last changed
+            session['expires'] = time.time() + self.ttl
+            self._dirty.add(user_id)
+
+    def flush(self):
+        now = time.time()
+        with self._lock:
+            dirty = [(user_id, dict(self._sessions[user_id], values=dict(self._sessions[user_id]['values'])))
+                     for user_id in self._dirty]
+            self._dirty = set()
+
+            # forget expired sessions so only recently active users are kept in memory
+            self._sessions = {user_id: session for user_id, session in self._sessions.items()
+                              if session['expires'] > now}
+
+        # sessions without values are cleared from the user store instead of written
+        for user_id, session in dirty:
+            if user_id not in self.users:
+                continue
+            if session['values'] and session['expires'] > now:
+                self.users.set(user_id, 'session', session)
+            else:
+                self.users.set(user_id, 'session', None)
+
+    def _session(self, user_id):
+        session = self._sessions.get(user_id)
+        if session is None or session['expires'] <= time.time():
+            # users without a session get an empty one so they aren't looked up again until it expires
+            session = None
+            if user_id in self.users:
+                session = self.users.get(user_id, 'session')
+            if session is None or session['expires'] <= time.time():
+                session = {'values': {}, 'expires': time.time() + self.ttl}
+            self._sessions[user_id] = session
+        return session
@@ -0,0 +1,189 @@
+import sqlite3
+import time
+import uuid
+from threading import Lock
+
+from counters import Counters
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+STATES = ('local', 'sqlite', 'redis')
+
+# prefix for every key kept in redis
+REDIS_PREFIX = 'ezstickerbot:'
+
+
+# counters and spam filter shared by every worker process through one backend
+class SharedState:
+    def __init__(self, counters, rate_limiter):
+        self.counters = counters
+        self.rate_limiter = rate_limiter
+
+    def flush(self):
+        self.counters.flush()
+        self.rate_limiter.sweep()
+
+
+# counts are added up in memory and the total of each counter only changes in the backend when flushed
+class BufferedCounters:
+    def __init__(self, names):
+        self.names = names
+        self._pending = Counters({name: 0 for name in names})
+        self._flushed = self._pending.values()
+        self._flush_lock = Lock()
+
+    def add(self, name, amount=1):
+        self._pending.add(name, amount)
+
+    def value(self, name):
+        return self.values()[name]
+
+    def values(self):
+        stored = self._read()
+        pending = self._pending.values()
+        return {name: stored.get(name, 0) + pending[name] - self._flushed[name] for name in self.names}
+
+    def flush(self):
+        with self._flush_lock:
+            pending = self._pending.values()
+            deltas = {name: pending[name] - self._flushed[name] for name in self.names}
+            deltas = {name: delta for name, delta in deltas.items() if delta}
+            if deltas:
+                self._write(deltas)
+            self._flushed = pending
+
+    def _read(self):
+        raise NotImplementedError
+
+    def _write(self, deltas):
+        raise NotImplementedError
+
+
+class SqliteCounters(BufferedCounters):
+    def __init__(self, db, db_lock, names, initial):
+        super().__init__(names)
+        self._db = db
+        self._db_lock = db_lock
+        with self._db_lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+            # counters start from the values in config.json the first time the database is used
+            self._db.executemany("INSERT OR IGNORE INTO counters VALUES (?, ?)", initial.items())
+            self._db.commit()
+
+    def _read(self):
+        with self._db_lock:
+            return dict(self._db.execute("SELECT name, value FROM counters"))
+
+    def _write(self, deltas):
+        with self._db_lock:
+            self._db.executemany("UPDATE counters SET value = value + ? WHERE name = ?",
+                                 [(delta, name) for name, delta in deltas.items()])
+            self._db.commit()
+
+
+# sliding window spam filter kept in a table of recent uses
+class SqliteRateLimiter:
+    def __init__(self, db, db_lock, max_uses, interval):
+        self.max_uses = max_uses
+        self.interval = interval
+        self._db = db
+        self._db_lock = db_lock
+        with self._db_lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS uses (user_id TEXT, time REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS uses_user_time ON uses (user_id, time)")
+            self._db.commit()
+
+    def record(self, user_id):
+        now = time.time()
+        with self._db_lock:
+            self._db.execute("INSERT INTO uses VALUES (?, ?)", (user_id, now))
+            self._db.execute("DELETE FROM uses WHERE user_id = ? AND time <= ?", (user_id, now - self.interval))
+            self._db.commit()
+
+    def cooldown(self, user_id):
+        # a user is limited when the oldest of their last max_uses uses is still inside the window
+        with self._db_lock:
+            rows = self._db.execute("SELECT time FROM uses WHERE user_id = ? ORDER BY time DESC LIMIT ?",
+                                    (user_id, self.max_uses)).fetchall()
+        if len(rows) < self.max_uses:
+            return 0
+        return max(0, self.interval - (time.time() - rows[-1][0]))
+
+    def configure(self, max_uses, interval):
+        self.max_uses = max_uses
+        self.interval = interval
+
+    def sweep(self):
+        # uses of users who haven't been back since are only deleted here
+        with self._db_lock:
+            self._db.execute("DELETE FROM uses WHERE time <= ?", (time.time() - self.interval,))
+            self._db.commit()
+
+
+def open_sqlite_state(path, initial_counters, max_uses, interval):
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db_lock = Lock()
+    return SharedState(SqliteCounters(db, db_lock, list(initial_counters), initial_counters),
+                       SqliteRateLimiter(db, db_lock, max_uses, interval))
+
+
+class RedisCounters(BufferedCounters):
+    def __init__(self, client, names, initial):
+        super().__init__(names)
+        self._client = client
+        for name, value in initial.items():
+            self._client.setnx(REDIS_PREFIX + 'counter:' + name, value)
+
+    def _read(self):
+        values = self._client.mget([REDIS_PREFIX + 'counter:' + name for name in self.names])
+        return {name: int(value) for name, value in zip(self.names, values) if value is not None}
+
+    def _write(self, deltas):
+        pipeline = self._client.pipeline()
+        for name, delta in deltas.items():
+            pipeline.incrby(REDIS_PREFIX + 'counter:' + name, delta)
+        pipeline.execute()
+
+
+# sliding window spam filter kept in a sorted set of use times for each user that expires with the window
+class RedisRateLimiter:
+    def __init__(self, client, max_uses, interval):
+        self.max_uses = max_uses
+        self.interval = interval
+        self._client = client
+
+    def record(self, user_id):
+        now = time.time()
+        key = REDIS_PREFIX + 'uses:' + user_id
+        pipeline = self._client.pipeline()
+        pipeline.zadd(key, {uuid.uuid4().hex: now})
+        pipeline.zremrangebyscore(key, 0, now - self.interval)
+        pipeline.expire(key, int(self.interval) + 1)
+        pipeline.execute()
+
+    def cooldown(self, user_id):
+        uses = self._client.zrange(REDIS_PREFIX + 'uses:' + user_id, -self.max_uses, -1, withscores=True)
+        if len(uses) < self.max_uses:
+            return 0
+        return max(0, self.interval - (time.time() - uses[0][1]))
+
+    def configure(self, max_uses, interval):
+        self.max_uses = max_uses
+        self.interval = interval
+
+    def sweep(self):
+        # keys expire on their own
+        pass
+
+
+def open_redis_state(url, initial_counters, max_uses, interval):
+    if redis is None:
+        raise RuntimeError("redis shared state needs the redis package installed")
+    client = redis.Redis.from_url(url)
+    return SharedState(RedisCounters(client, list(initial_counters), initial_counters),
+                       RedisRateLimiter(client, max_uses, interval))
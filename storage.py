@@ -0,0 +1,363 @@
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+
+# user keys stored in their own columns, any other keys are stored as json in the extra column
+COLUMNS = ('lang', 'opt_in', 'uses', 'icon_warned')
+BOOLEAN_COLUMNS = ('opt_in', 'icon_warned')
+
+# user keys with a running count of users for each value
+AGGREGATED_KEYS = ('lang', 'opt_in')
+
+# values users start with, default_user in config.json overrides them so configs from before a key was added still
+# work without being edited
+DEFAULT_USER = {'lang': 'en', 'opt_in': True, 'uses': 0, 'icon_warned': False, 'blocked': False, 'session': None}
+
+
+# keeps user records in memory and tracks which keys of which ones changed so flush only writes those
+class UserStore:
+    def __init__(self, default_user, cache_size=None):
+        self.default_user = dict(DEFAULT_USER, **default_user)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        # changed keys of each changed user, None when the whole record is new
+        self._dirty = {}
+        self._flushing = {}
+        self._count = 0
+        self._aggregates = {key: {} for key in AGGREGATED_KEYS}
+        self._lock = Lock()
+
+    def __contains__(self, user_id):
+        with self._lock:
+            return self._record(int(user_id)) is not None
+
+    def __len__(self):
+        return self._count
+
+    def register(self, user_id, record):
+        user_id = int(user_id)
+        with self._lock:
+            # another thread may have registered the user first
+            if self._record(user_id) is not None:
+                return False
+            self._cache[user_id] = dict(record)
+            self._dirty[user_id] = None
+            self._count += 1
+            for key in AGGREGATED_KEYS:
+                self._aggregate(key, record.get(key), 1)
+            self._evict()
+            return True
+
+    def get(self, user_id, key):
+        user_id = int(user_id)
+        with self._lock:
+            record = self._record(user_id)
+
+            # if user does not have requested key return the default value, it isn't written so a stale copy of the
+            # user in another process can't overwrite a value set since
+            if key not in record:
+                try:
+                    return self.default_user[key].copy()
+                # if value isn't a type with a copy function like a string or int
+                except AttributeError:
+                    return self.default_user[key]
+            return record[key]
+
+    def set(self, user_id, key, value):
+        user_id = int(user_id)
+        with self._lock:
+            record = self._record(user_id)
+            if key in AGGREGATED_KEYS:
+                self._aggregate(key, record.get(key), -1)
+                self._aggregate(key, value, 1)
+            record[key] = value
+            self._mark(user_id, key)
+
+    def increment(self, user_id, key, amount=1):
+        user_id = int(user_id)
+        with self._lock:
+            record = self._record(user_id)
+            record[key] = record.get(key, 0) + amount
+            self._mark(user_id, key)
+            return record[key]
+
+    def opt_in_counts(self):
+        with self._lock:
+            counts = self._aggregates['opt_in']
+            return counts.get(True, 0), counts.get(False, 0)
+
+    def lang_counts(self):
+        with self._lock:
+            return {code: count for code, count in self._aggregates['lang'].items() if count}
+
+    def flush(self):
+        # copy changed records so other threads can keep changing users while they are written
+        with self._lock:
+            records = [(user_id, keys, dict(self._cache[user_id])) for user_id, keys in self._dirty.items()]
+            self._flushing, self._dirty = self._dirty, {}
+        if not records:
+            return
+
+        try:
+            self._write(records)
+        except (OSError, sqlite3.Error):
+            # keep the records dirty so the next flush tries again
+            with self._lock:
+                for user_id, keys in self._flushing.items():
+                    if keys is None:
+                        self._dirty[user_id] = None
+                    else:
+                        for key in keys:
+                            self._mark(user_id, key)
+            raise
+        finally:
+            with self._lock:
+                self._flushing = {}
+
+    def _mark(self, user_id, key):
+        keys = self._dirty.setdefault(user_id, set())
+        if keys is not None:
+            keys.add(key)
+
+    def _aggregate(self, key, value, amount):
+        # users without a value for the key are not counted
+        if value is not None:
+            counts = self._aggregates[key]
+            counts[value] = counts.get(value, 0) + amount
+
+    def _record(self, user_id):
+        record = self._cache.get(user_id)
+        if record is not None:
+            self._cache.move_to_end(user_id)
+            return record
+
+        record = self._fetch(user_id)
+        if record is None:
+            return None
+        self._cache[user_id] = record
+        self._evict()
+        return record
+
+    def _evict(self):
+        if self.cache_size is None:
+            return
+
+        # only records that have been written can be dropped from the cache
+        while len(self._cache) > self.cache_size:
+            user_id = next(iter(self._cache))
+            if user_id in self._dirty or user_id in self._flushing:
+                break
+            del self._cache[user_id]
+
+    def _fetch(self, user_id):
+        return None
+
+    def _write(self, records):
+        raise NotImplementedError
+
+
+# user store backed by sqlite that only keeps recently used users in memory
+class SqliteUserStore(UserStore):
+    def __init__(self, path, default_user, cache_size):
+        super().__init__(default_user, cache_size)
+        self._db_lock = Lock()
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, lang TEXT, opt_in INTEGER, "
+                         "uses INTEGER, icon_warned INTEGER, extra TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS users_lang ON users (lang)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS users_opt_in ON users (opt_in)")
+        self._db.commit()
+        self._count = self._db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        self._count_aggregates()
+
+    def ids(self):
+        self.flush()
+        with self._db_lock:
+            return [row[0] for row in self._db.execute("SELECT user_id FROM users ORDER BY user_id")]
+
+    def broadcast_targets(self, first_id, last_id, include_opted_out):
+        # read from the database instead of the cache since other workers change users this one has cached
+        self.flush()
+        with self._db_lock:
+            rows = self._db.execute("SELECT user_id FROM users WHERE user_id BETWEEN ? AND ? AND "
+                                    "(COALESCE(opt_in, ?) OR ?) AND NOT COALESCE(json_extract(extra, '$.blocked'), ?)",
+                                    (first_id, last_id, int(self.default_user['opt_in']), int(include_opted_out),
+                                     int(self.default_user['blocked']))).fetchall()
+        return {row[0] for row in rows}
+
+    def migrate(self, users):
+        rows = [to_row(int(user_id), record) for user_id, record in users.items()]
+        with self._lock, self._db_lock:
+            self._db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+            self._cache.clear()
+            self._dirty.clear()
+            self._count = self._db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            self._count_aggregates()
+
+    def recount(self):
+        # counts kept by this process drift when other processes change users so count them again
+        with self._lock, self._db_lock:
+            self._count = self._db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            self._count_aggregates()
+
+    def close(self):
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    def _count_aggregates(self):
+        # counted once from the indexed columns and kept up to date as users change after that
+        for key in AGGREGATED_KEYS:
+            rows = self._db.execute("SELECT {0}, COUNT(*) FROM users GROUP BY {0}".format(key)).fetchall()
+            if key in BOOLEAN_COLUMNS:
+                rows = [(bool(value) if value is not None else None, count) for value, count in rows]
+            self._aggregates[key] = {value: count for value, count in rows if value is not None}
+
+    def _fetch(self, user_id):
+        with self._db_lock:
+            row = self._db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return from_row(row) if row is not None else None
+
+    def _write(self, records):
+        # only the keys that changed are written since workers share the database and each keeps its own copy of
+        # users, a whole row would overwrite what other workers changed
+        rows = []
+        columns = []
+        extras = []
+        for user_id, keys, record in records:
+            if keys is None:
+                rows.append(to_row(user_id, record))
+                continue
+            for key in keys:
+                if key in COLUMNS:
+                    value = int(record[key]) if key in BOOLEAN_COLUMNS else record[key]
+                    columns.append((key, value, user_id))
+                else:
+                    extras.append(('$."{}"'.format(key), json.dumps(record[key]), user_id))
+
+        with self._db_lock:
+            # users registered by another worker in the meantime are kept
+            self._db.executemany("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?, ?, ?)", rows)
+            for key, value, user_id in columns:
+                self._db.execute("UPDATE users SET {} = ? WHERE user_id = ?".format(key), (value, user_id))
+            self._db.executemany("UPDATE users SET extra = json_set(COALESCE(extra, '{}'), ?, json(?)) "
+                                 "WHERE user_id = ?", extras)
+            self._db.commit()
+
+
+# user store kept fully in memory and saved as a json snapshot plus an append only journal of changed users
+class JournalUserStore(UserStore):
+    def __init__(self, snapshot_path, journal_path, default_user, compact_after):
+        super().__init__(default_user)
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_after = compact_after
+        self._file_lock = Lock()
+        self._seq = 0
+        self._journal_entries = 0
+
+        # load the last snapshot, older snapshots are a plain dict of users
+        try:
+            with open(snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except FileNotFoundError:
+            snapshot = {}
+        if 'seq' in snapshot and 'users' in snapshot:
+            self._seq = snapshot['seq']
+            snapshot = snapshot['users']
+        for user_id, record in snapshot.items():
+            self._cache[int(user_id)] = record
+
+        # replay changes journaled after the snapshot was taken
+        try:
+            with open(journal_path) as journal_file:
+                for line in journal_file:
+                    try:
+                        seq, user_id, record = json.loads(line)
+                    # a crash while appending can leave the last line incomplete
+                    except ValueError:
+                        break
+                    if seq > self._seq:
+                        self._cache[user_id] = record
+                        self._seq = seq
+                    self._journal_entries += 1
+        except FileNotFoundError:
+            pass
+
+        self._count = len(self._cache)
+        for record in self._cache.values():
+            for key in AGGREGATED_KEYS:
+                self._aggregate(key, record.get(key), 1)
+
+    def ids(self):
+        with self._lock:
+            return sorted(self._cache)
+
+    def broadcast_targets(self, first_id, last_id, include_opted_out):
+        with self._lock:
+            return {user_id for user_id, record in self._cache.items() if first_id <= user_id <= last_id and
+                    (record.get('opt_in', self.default_user['opt_in']) or include_opted_out) and
+                    not record.get('blocked', self.default_user['blocked'])}
+
+    def records(self):
+        with self._lock:
+            return {user_id: dict(record) for user_id, record in self._cache.items()}
+
+    def close(self):
+        self.flush()
+
+    def _write(self, records):
+        with self._file_lock:
+            lines = []
+            for user_id, _, record in records:
+                self._seq += 1
+                lines.append(json.dumps([self._seq, user_id, record]) + '\n')
+            with open(self.journal_path, 'a') as journal_file:
+                journal_file.writelines(lines)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self._journal_entries += len(lines)
+
+            # fold the journal into a new snapshot once it has grown as large as the user table
+            if self._journal_entries >= max(self.compact_after, self._count):
+                self._compact()
+
+    def _compact(self):
+        # the snapshot records the last journaled change it contains so a crash before the journal
+        # is truncated can't replay older changes over it
+        with self._lock:
+            users = {user_id: dict(record) for user_id, record in self._cache.items()}
+        write_atomic(self.snapshot_path, json.dumps({'seq': self._seq, 'users': users}))
+        open(self.journal_path, 'w').close()
+        self._journal_entries = 0
+
+
+def write_atomic(path, data):
+    # write next to the target and swap it in so a crash never leaves a truncated file
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as temp_file:
+        temp_file.write(data)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
+
+
+def to_row(user_id, record):
+    extra = {key: value for key, value in record.items() if key not in COLUMNS}
+    values = [int(record[key]) if key in BOOLEAN_COLUMNS and key in record else record.get(key) for key in COLUMNS]
+    return (user_id, *values, json.dumps(extra) if extra else None)
+
+
+def from_row(row):
+    record = json.loads(row[-1]) if row[-1] else {}
+    for key, value in zip(COLUMNS, row[1:-1]):
+        # leave keys the user never had missing so they get the default value
+        if value is not None:
+            record[key] = bool(value) if key in BOOLEAN_COLUMNS else value
+    return record
@@ -0,0 +1,154 @@
+import asyncio
+import socket
+import unittest
+
+from aiohttp import web
+
+from fetcher import CHUNK_SIZE, FetchError, Fetcher
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 1000
+WEBP = b'RIFF\x00\x00\x00\x00WEBPVP8 ' + b'\x00' * 1000
+HTML = b'<!doctype html><html><body>' + b'x' * 1000 + b'</body></html>'
+
+MAX_SIZE = 4 * CHUNK_SIZE
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# serves files the way image hosts do, with or without telling their size up front
+class FetcherTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.sent = {}
+        self.active = 0
+        self.most_active = 0
+
+        app = web.Application()
+        app.router.add_get('/image.png', self.sized(PNG))
+        app.router.add_get('/image.webp', self.sized(WEBP))
+        app.router.add_get('/page.html', self.streamed('page.html', HTML, 1))
+        app.router.add_get('/large.png', self.sized(PNG + b'\x00' * MAX_SIZE))
+        app.router.add_get('/streamed.png', self.streamed('streamed.png', PNG, 3))
+        app.router.add_get('/streamed-large.png', self.streamed('streamed-large.png', PNG, 64))
+        app.router.add_get('/streamed-page.html', self.streamed('streamed-page.html', HTML, 64))
+        app.router.add_get('/slow.png', self.slow)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        self.port = free_port()
+        await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+
+        self.fetcher = Fetcher(MAX_SIZE, 2, 2, 60, 10)
+
+    async def asyncTearDown(self):
+        await self.fetcher.close()
+        await self.runner.cleanup()
+
+    def url(self, path, port=None):
+        return 'http://127.0.0.1:{}/{}'.format(port or self.port, path)
+
+    def sized(self, body):
+        async def handle(request):
+            return web.Response(body=body)
+
+        return handle
+
+    def streamed(self, name, first_chunk, chunks):
+        # chunked responses have no content length so the fetcher only knows their size by counting
+        async def handle(request):
+            response = web.StreamResponse()
+            response.enable_chunked_encoding()
+            await response.prepare(request)
+            self.sent[name] = 0
+            try:
+                for index in range(chunks):
+                    chunk = first_chunk if index == 0 else b'\x00' * CHUNK_SIZE
+                    await response.write(chunk)
+                    self.sent[name] += len(chunk)
+                    await asyncio.sleep(0.01)
+                await response.write_eof()
+            except ConnectionError:
+                pass
+            return response
+
+        return handle
+
+    async def slow(self, request):
+        self.active += 1
+        self.most_active = max(self.most_active, self.active)
+        try:
+            await asyncio.sleep(0.2)
+            return web.Response(body=PNG)
+        finally:
+            self.active -= 1
+
+    async def assertFetchError(self, url, reason):
+        with self.assertRaises(FetchError) as context:
+            await self.fetcher.fetch(url)
+        self.assertEqual(context.exception.reason, reason)
+
+    async def test_fetches_images(self):
+        self.assertEqual(await self.fetcher.fetch(self.url('image.png')), PNG)
+        self.assertEqual(await self.fetcher.fetch(self.url('image.webp')), WEBP)
+
+    async def test_fetches_without_content_length(self):
+        content = await self.fetcher.fetch(self.url('streamed.png'))
+        self.assertEqual(len(content), len(PNG) + 2 * CHUNK_SIZE)
+        self.assertTrue(content.startswith(PNG))
+
+    async def test_refuses_reported_size_over_cap(self):
+        await self.assertFetchError(self.url('large.png'), 'file_too_large')
+
+    async def test_stops_counted_size_over_cap(self):
+        await self.assertFetchError(self.url('streamed-large.png'), 'file_too_large')
+        # the download stops soon after the cap instead of reading the whole response
+        await asyncio.sleep(0.1)
+        self.assertLess(self.sent['streamed-large.png'], 32 * CHUNK_SIZE)
+
+    async def test_refuses_content_that_is_not_an_image(self):
+        await self.assertFetchError(self.url('page.html'), 'url_not_img')
+
+    async def test_stops_at_signature_that_is_not_an_image(self):
+        await self.assertFetchError(self.url('streamed-page.html'), 'url_not_img')
+        await asyncio.sleep(0.1)
+        self.assertLess(self.sent['streamed-page.html'], 32 * CHUNK_SIZE)
+
+    async def test_missing_file(self):
+        await self.assertFetchError(self.url('missing.png'), 'url_does_not_exist')
+
+    async def test_invalid_urls(self):
+        await self.assertFetchError('ftp://127.0.0.1/image.png', 'invalid_url')
+        await self.assertFetchError('https://', 'invalid_url')
+
+    async def test_limits_connections_per_host(self):
+        contents = await asyncio.gather(*(self.fetcher.fetch(self.url('slow.png')) for _ in range(6)))
+        self.assertEqual(contents, [PNG] * 6)
+        self.assertEqual(self.most_active, 2)
+
+    async def test_remembers_hosts_that_failed_to_connect(self):
+        port = free_port()
+        await self.assertFetchError(self.url('image.png', port), 'unable_to_connect')
+
+        # the host isn't tried again until the failure expires even once it is back
+        runner = web.AppRunner(web.Application())
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, '127.0.0.1', port).start()
+            await self.assertFetchError(self.url('image.png', port), 'unable_to_connect')
+        finally:
+            await runner.cleanup()
+
+    async def test_failures_only_affect_their_port(self):
+        await self.assertFetchError(self.url('image.png', free_port()), 'unable_to_connect')
+        self.assertEqual(await self.fetcher.fetch(self.url('image.png')), PNG)
+
+    async def test_failures_expire(self):
+        self.fetcher.failure_ttl = 0
+        await self.assertFetchError(self.url('image.png', free_port()), 'unable_to_connect')
+        self.assertEqual(await self.fetcher.fetch(self.url('image.png')), PNG)
+
+
+if __name__ == '__main__':
+    unittest.main()
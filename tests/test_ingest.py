@@ -0,0 +1,140 @@
+import json
+import os
+import socket
+import tempfile
+import unittest
+from queue import Queue
+
+from aiohttp import ClientSession
+from telegram import Bot, Update
+
+from ingest import SECRET_HEADER, WebhookServer, load_pending_updates, save_pending_updates
+
+SECRET = 'secret-token'
+
+# updates as telegram posts them
+PHOTO_UPDATE = {
+    'update_id': 512000001,
+    'message': {
+        'message_id': 1201, 'date': 1700000000,
+        'from': {'id': 900000001, 'is_bot': False, 'first_name': "Ada", 'language_code': 'es'},
+        'chat': {'id': 900000001, 'type': 'private', 'first_name': "Ada"},
+        'photo': [{'file_id': 'AgADsmall', 'file_unique_id': 'small', 'width': 90, 'height': 60, 'file_size': 1200},
+                  {'file_id': 'AgADlarge', 'file_unique_id': 'large', 'width': 1280, 'height': 853,
+                   'file_size': 98000}]
+    }
+}
+COMMAND_UPDATE = {
+    'update_id': 512000002,
+    'message': {
+        'message_id': 1202, 'date': 1700000001,
+        'from': {'id': 900000002, 'is_bot': False, 'first_name': "Grace", 'language_code': 'en'},
+        'chat': {'id': 900000002, 'type': 'private', 'first_name': "Grace"},
+        'text': '/icon', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}]
+    }
+}
+CALLBACK_UPDATE = {
+    'update_id': 512000003,
+    'callback_query': {
+        'id': '4382', 'chat_instance': '-1234', 'data': 'lang:de',
+        'from': {'id': 900000003, 'is_bot': False, 'first_name': "Alan"}
+    }
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# posts updates to the listener the way telegram does
+class WebhookServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.bot = Bot('123456:TEST')
+        self.queue = Queue()
+        port = free_port()
+        self.url = 'http://127.0.0.1:{}/hook'.format(port)
+        self.server = WebhookServer(self.bot, self.queue, '127.0.0.1', port, '/hook', SECRET)
+        await self.server.start()
+        self.session = ClientSession()
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.server.stop()
+
+    async def post(self, payload, secret=SECRET):
+        headers = {SECRET_HEADER: secret} if secret is not None else {}
+        async with self.session.post(self.url, data=payload, headers=headers) as response:
+            return response.status
+
+    async def test_queues_updates(self):
+        for payload in (PHOTO_UPDATE, COMMAND_UPDATE, CALLBACK_UPDATE):
+            self.assertEqual(await self.post(json.dumps(payload)), 200)
+
+        photo, command, callback = (self.queue.get_nowait() for _ in range(3))
+        self.assertIsInstance(photo, Update)
+        self.assertEqual(photo.update_id, PHOTO_UPDATE['update_id'])
+        self.assertEqual(photo.message.photo[-1].file_id, 'AgADlarge')
+        self.assertEqual(command.message.text, '/icon')
+        self.assertEqual(callback.callback_query.data, 'lang:de')
+        self.assertTrue(self.queue.empty())
+
+    async def test_rejects_wrong_secret(self):
+        self.assertEqual(await self.post(json.dumps(PHOTO_UPDATE), 'wrong'), 403)
+        self.assertTrue(self.queue.empty())
+
+    async def test_rejects_missing_secret(self):
+        self.assertEqual(await self.post(json.dumps(PHOTO_UPDATE), None), 403)
+        self.assertTrue(self.queue.empty())
+
+    async def test_rejects_invalid_json(self):
+        self.assertEqual(await self.post('{"update_id": '), 400)
+        self.assertTrue(self.queue.empty())
+
+    async def test_rejects_json_that_is_not_an_object(self):
+        self.assertEqual(await self.post(json.dumps([PHOTO_UPDATE])), 400)
+        self.assertEqual(await self.post('"update"'), 400)
+        self.assertTrue(self.queue.empty())
+
+    async def test_rejects_empty_update(self):
+        self.assertEqual(await self.post('{}'), 400)
+        self.assertTrue(self.queue.empty())
+
+
+class PendingUpdatesTest(unittest.TestCase):
+    def setUp(self):
+        self.bot = Bot('123456:TEST')
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'pending_updates.json')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_saves_and_loads_pending_updates(self):
+        queue = Queue()
+        for payload in (PHOTO_UPDATE, COMMAND_UPDATE, CALLBACK_UPDATE):
+            queue.put(Update.de_json(payload, self.bot))
+        # anything else the dispatcher was given isn't an update and isn't saved
+        queue.put('not an update')
+
+        last_update_id = save_pending_updates(queue, self.path, 512000000)
+        self.assertEqual(last_update_id, CALLBACK_UPDATE['update_id'])
+        self.assertTrue(queue.empty())
+
+        updates = load_pending_updates(self.path, self.bot)
+        self.assertEqual([update.update_id for update in updates],
+                         [PHOTO_UPDATE['update_id'], COMMAND_UPDATE['update_id'], CALLBACK_UPDATE['update_id']])
+        self.assertEqual(updates[0].message.photo[-1].file_id, 'AgADlarge')
+        # loaded updates are removed so they are only handled once
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_keeps_restart_update_id_without_pending_updates(self):
+        last_update_id = save_pending_updates(Queue(), self.path, 512000009)
+        self.assertEqual(last_update_id, 512000009)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(load_pending_updates(self.path, self.bot), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
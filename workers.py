@@ -0,0 +1,46 @@
+import logging
+import multiprocessing
+
+logger = logging.getLogger()
+
+
+# worker processes that each handle the updates of a share of the users
+class WorkerPool:
+    def __init__(self, count, target):
+        # spawn so workers don't inherit the threads and connections of the process routing updates
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue() for _ in range(count)]
+        self.processes = [context.Process(target=target, args=(index, queue), name="worker-{}".format(index))
+                          for index, queue in enumerate(self.queues)]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def route(self, update, index=None):
+        # every update from a user goes to the same worker so their state is only ever changed by one process
+        if index is None:
+            user = update.effective_user
+            index = user.id % len(self.queues) if user is not None else 0
+        self.queues[index].put(update.to_dict())
+
+    def stop(self, timeout):
+        # workers handle everything already routed to them before the stop and then exit
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("Worker {} did not stop in time".format(process.name))
+                process.terminate()
+
+    def depths(self):
+        # number of updates routed to each worker that it hasn't taken yet
+        depths = {}
+        for index, queue in enumerate(self.queues):
+            try:
+                depths[index] = queue.qsize()
+            except NotImplementedError:
+                # macos has no way to tell
+                pass
+        return depths